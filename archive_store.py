@@ -0,0 +1,125 @@
+##########################
+# This file contains the local store of downloaded beatmap archives (.osz).
+# Archives are kept exactly as they were downloaded, keyed by the sha1 of their contents (the archive_sha1 the
+# catalog records for every map), and compressed with zlib. The data folders can then be rebuilt from the store
+# (see data_collector.reprocess) whenever parsing, the target format or cropping changes, without downloading
+# anything again. The least recently used archives are evicted once the store grows past its size budget.
+#
+# Layout of the store directory:
+#   <sha1[:2]>/<sha1>.osz.z    one zlib-compressed archive per distinct download
+##########################
+
+
+# Python library imports
+import hashlib
+import os
+import threading
+import zlib
+
+
+# Our imports
+import config
+
+
+class ArchiveStore:
+    """
+    A class that represents a size-capped, content-addressed store of compressed archives.
+    It is safe to use from several threads; several processes may read from it at once.
+    """
+    def __init__(self, path=config.archive_path, max_bytes=config.archive_store_size, level=config.archive_compression):
+        """
+        @param path: The store directory.
+        @param max_bytes: The maximum total size of the stored (compressed) archives.
+        @param level: The zlib compression level (0 stores archives uncompressed, 9 is the smallest).
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.level = level
+        self.size = None # total bytes stored, counted on the first put
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, sha1):
+        return os.path.join(self.path, sha1[:2], sha1 + ".osz.z")
+
+    def __contains__(self, sha1):
+        return os.path.isfile(self.filename(sha1))
+
+    def put(self, content):
+        """
+        Stores an archive (if it is not stored yet) and evicts old archives if the store is over its budget.
+        The archive is written to a temporary file first so readers never see a partial entry.
+        @return: The sha1 hex digest of the archive.
+        """
+        sha1 = hashlib.sha1(content).hexdigest()
+        filename = self.filename(sha1)
+        if os.path.isfile(filename):
+            os.utime(filename) # mark as recently used
+            return sha1
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_path = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        data = zlib.compress(content, self.level)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, filename)
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+        return sha1
+
+    def get(self, sha1):
+        """
+        Returns the archive with the given sha1, or None if it is not stored (or its file is damaged).
+        """
+        filename = self.filename(sha1)
+        try:
+            with open(filename, "rb") as f:
+                content = zlib.decompress(f.read())
+        except (FileNotFoundError, zlib.error):
+            return None
+        try:
+            os.utime(filename) # mark as recently used
+        except OSError:
+            pass # (read-only storage, or the archive was just evicted)
+        if hashlib.sha1(content).hexdigest() != sha1:
+            return None
+        return content
+
+    def entries(self):
+        """
+        Returns (mtime, size, filename) of every stored archive.
+        """
+        entries = []
+        for folder in os.listdir(self.path):
+            folder = os.path.join(self.path, folder)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.endswith(".osz.z"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(folder, name)))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used archives until the store is under its size budget.
+        """
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.size = total
@@ -0,0 +1,161 @@
+##########################
+# This file contains the compact target format for beatmaps.
+# Hit objects are stored as a typed event table (one row per hit object) and slider points as a
+# ragged offsets + values array, so storage scales with the number of objects instead of the song length.
+# densify() materializes the dense per-millisecond rows (the format the model trains on) on demand.
+# densify_frames() materializes rows on the spectrogram's frame grid instead (one row per ~46 ms frame), with the
+# offset of each object from the start of its frame as an extra column; events_from_frames() converts such rows
+# back to exact ms times.
+##########################
+
+
+# Python library imports
+import os
+import numpy as np
+
+
+# One row per hit object
+event_dtype = np.dtype([
+    ("time", np.int32),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("type", np.int32),
+    ("curve", np.int32),
+    ("slides", np.int32),
+    ("length", np.float32),
+    ("end_time", np.int32),
+])
+
+# Number of columns in a dense target row: x, y, hit, type, curve, slides, length, end time
+num_columns = 8
+
+# Number of columns in a frame grid row: the dense columns and the offset of the object into the frame (ms)
+frame_columns = 9
+
+
+def save_events(path, events, offsets, values):
+    """
+    Saves an event table and its slider points to an .npz file (written to a temporary file first).
+    The slider points of event i are values[offsets[i]:offsets[i+1]].
+    """
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, events=events, offsets=offsets, values=values)
+    os.replace(tmp_path, path)
+
+
+def load_events(path):
+    """
+    Loads an event table and its slider points from an .npz file.
+    @return: (events, offsets, values)
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return data["events"], data["offsets"], data["values"]
+
+
+def get_length(events):
+    """
+    Returns the number of dense 1 ms rows the events span (last hit time + 1).
+    """
+    return int(events["time"].max()) + 1 if len(events) > 0 else 0
+
+
+def densify(events, start=0, stop=None, resolution=1):
+    """
+    Materializes the dense target rows for a time window.
+    Row i covers [start + i*resolution, start + (i+1)*resolution) ms. If several objects fall into the same
+    row, the first one in the table is kept.
+    @param events: The event table.
+    @param start: The start of the window in ms.
+    @param stop: The end of the window in ms (defaults to the last hit time + 1).
+    @param resolution: The length of one row in ms.
+    @return: A float32 array of shape (rows, 8).
+    """
+    if stop is None:
+        stop = get_length(events)
+    num_rows = max(0, -(-(stop - start) // resolution))
+    out = np.zeros((num_rows, num_columns), dtype=np.float32)
+
+    in_window = (events["time"] >= start) & (events["time"] < stop)
+    window = events[in_window][::-1] # reversed so the first object in a row is written last
+    fill_rows(out, (window["time"] - start) // resolution, window)
+    return out
+
+
+def fill_rows(out, rows, window):
+    """
+    Writes the dense columns of the events in window to the given rows of out.
+    """
+    out[rows, 0] = window["x"]
+    out[rows, 1] = window["y"]
+    out[rows, 2] = 1
+    out[rows, 3] = window["type"]
+    out[rows, 4] = window["curve"]
+    out[rows, 5] = window["slides"]
+    out[rows, 6] = window["length"]
+    out[rows, 7] = window["end_time"]
+
+
+def densify_frames(events, frame_ms, start=0, stop=None):
+    """
+    Materializes the target rows for a window of spectrogram frames.
+    Row i covers frame start + i, i.e. [(start + i)*frame_ms, (start + i + 1)*frame_ms) ms. Besides the dense
+    columns, a row holds the offset of its object from the start of the frame in ms, so the exact time is kept.
+    If several objects fall into the same frame, the first one in the table is kept.
+    @param events: The event table.
+    @param frame_ms: The length of one frame in ms (hop length / sample rate * 1000).
+    @param start: The first frame of the window.
+    @param stop: The frame after the end of the window (defaults to the frame after the last hit).
+    @return: A float32 array of shape (rows, 9).
+    """
+    frames = (events["time"] // frame_ms).astype(np.int64)
+    if stop is None:
+        stop = int(frames.max()) + 1 if len(events) > 0 else 0
+    out = np.zeros((max(0, stop - start), frame_columns), dtype=np.float32)
+
+    in_window = (frames >= start) & (frames < stop)
+    window = events[in_window][::-1] # reversed so the first object in a frame is written last
+    window_frames = frames[in_window][::-1]
+    rows = window_frames - start
+    fill_rows(out, rows, window)
+    out[rows, 8] = window["time"] - window_frames * frame_ms
+    return out
+
+
+def pad_slider_points(events, offsets, values):
+    """
+    Returns the slider points as a dense (num_sliders, max_points, 2) array padded with zeros.
+    """
+    counts = np.diff(offsets)[(events["type"] & 0b00000010) != 0]
+    if len(counts) == 0:
+        return np.zeros((0, 0, 2), dtype=np.int32)
+    out = np.zeros((len(counts), counts.max(), 2), dtype=np.int32)
+    slider = np.repeat(np.arange(len(counts)), counts)
+    pos = np.arange(len(values)) - np.repeat(np.cumsum(counts) - counts, counts)
+    out[slider, pos] = values
+    return out
+
+
+def events_from_dense(rows, start=0, resolution=1):
+    """
+    Converts dense target rows (as produced by densify or stored in the old pickles) back into an event table.
+    """
+    rows = np.asarray(rows)
+    hit = np.flatnonzero(rows[:, 2]) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    events = np.zeros(len(hit), dtype=event_dtype)
+    events["time"] = start + hit * resolution
+    for name, col in (("x", 0), ("y", 1), ("type", 3), ("curve", 4), ("slides", 5), ("length", 6), ("end_time", 7)):
+        events[name] = rows[hit, col]
+    return events
+
+
+def events_from_frames(rows, frame_ms, start=0):
+    """
+    Converts frame grid rows (as produced by densify_frames or generated on the frame grid) back into an event
+    table, with each object at the start of its frame plus its offset, rounded to the nearest ms.
+    @param start: The frame of the first row.
+    """
+    rows = np.asarray(rows)
+    events = events_from_dense(rows[:, :num_columns], 0, 1)
+    hit = np.flatnonzero(rows[:, 2]) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    events["time"] = np.round((start + hit) * frame_ms + np.clip(rows[hit, 8], 0, frame_ms))
+    return events
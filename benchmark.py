@@ -0,0 +1,251 @@
+#################################
+# Description: This script benchmarks every stage of the project on synthetic data.
+# The .osu files and audio are generated offline from a fixed seed, so results are comparable between runs.
+# Each run is appended to a JSON lines history, and can be compared against a saved baseline to catch
+# throughput regressions (the script exits with status 1 if any stage got slower than the tolerance).
+#################################
+
+# Python library imports
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import sys
+import time
+import wave
+import numpy as np
+import torch
+from torch.optim import Adam
+
+# Our imports
+import config
+import model
+import data_collector
+import osu_beatmap_generator
+from feature_cache import FeatureCache
+from manifest import Manifest, make_entry
+from beatmap_events import save_events, get_length
+from model import Audio2Map, Encoder, Decoder, collate_maps, masked_mse_loss, convert_to_spectrogram
+from train import train_step
+
+# Configuration
+history_path = config.benchmark_path + "history.jsonl"
+baseline_path = config.benchmark_path + "baseline.json"
+
+# Benchmark sizes: (song seconds, hit objects per map, songs in the dataset/batch)
+sizes = {"quick": (10, 500, 2), "full": (60, 3000, 8)}
+
+
+####################################
+# Synthetic data
+####################################
+
+
+def write_synthetic_osu(filename, num_objects, song_ms, rng):
+    """
+    Writes an .osu file with random circles, sliders and spinners spread over song_ms milliseconds.
+    """
+    times = np.sort(rng.choice(np.arange(500, song_ms - 1000), size=num_objects, replace=False))
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("osu file format v14\n\n[General]\nAudioFilename: audio.mp3\n\n")
+        f.write("[Difficulty]\nHPDrainRate:5\nCircleSize:4\nOverallDifficulty:8\nApproachRate:9\nSliderMultiplier:1.4\nSliderTickRate:1\n\n")
+        f.write("[TimingPoints]\n0,500,4,2,0,60,1,0\n10000,-100,4,2,0,60,0,0\n\n")
+        f.write("[HitObjects]\n")
+        for t in times:
+            x, y = rng.integers(0, 512), rng.integers(0, 384)
+            kind = rng.random()
+            if kind < 0.6:
+                f.write(f"{x},{y},{t},1,0,0:0:0:0:\n")
+            elif kind < 0.97:
+                points = "|".join(f"{rng.integers(0, 512)}:{rng.integers(0, 384)}" for _ in range(rng.integers(1, 5)))
+                f.write(f"{x},{y},{t},2,0,{rng.choice(list('BLPC'))}|{points},{rng.integers(1, 3)},{rng.integers(20, 300)},2|0,0:0|0:0,0:0:0:0:\n")
+            else:
+                f.write(f"256,192,{t},8,0,{t + 800},0:0:0:0:\n")
+
+
+def write_synthetic_audio(filename, seconds, rng, sr=22050):
+    """
+    Writes a 16-bit mono .wav with a click track over a few random tones (so the spectrogram is not empty).
+    """
+    t = np.arange(int(seconds * sr)) / sr
+    y = sum(0.1 * np.sin(2 * np.pi * f * t) for f in rng.uniform(110, 1760, size=4))
+    y[(np.arange(len(t)) % (sr // 2)) < 200] += 0.5
+    with wave.open(filename, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes((np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def make_dataset(path, seconds, num_objects, num_songs, rng):
+    """
+    Creates num_songs synthetic songs with one difficulty each, and a manifest for them.
+    @return: The manifest path.
+    """
+    m = Manifest(os.path.join(path, "manifest.jsonl"))
+    for i in range(num_songs):
+        audio_file = os.path.join(path, f"{i}.wav")
+        map_file = os.path.join(path, f"{i}_0.osu")
+        target_file = os.path.join(path, f"{i}_0.npz")
+        write_synthetic_audio(audio_file, seconds, rng)
+        write_synthetic_osu(map_file, num_objects, seconds * 1000, rng)
+        events = data_collector.formatEvents(map_file)
+        save_events(target_file, *events)
+        m.add(make_entry(i, 0, audio_file, target_file, [5, 4, 8, 9, 1.4, 1], get_length(events[0])))
+    return m.path
+
+
+####################################
+# Benchmarks
+####################################
+
+
+def measure(fn, repeats):
+    """
+    Runs fn once to warm up and then repeats times. Returns the median time of one call in seconds.
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def run_benchmarks(size="quick", repeats=5, seed=0):
+    """
+    Runs every benchmark on synthetic data. Returns a dict of name -> {"seconds": ..., <throughput>: ...}.
+    """
+    seconds, num_objects, num_songs = sizes[size]
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as path:
+        path += "/"
+        manifest_path = make_dataset(path, seconds, num_objects, num_songs, rng)
+        map_file = path + "0_0.osu"
+        audio_file = path + "0.wav"
+
+        # Parsing
+        t = measure(lambda: data_collector.getOutput(map_file), repeats)
+        results["parse.getOutput"] = {"seconds": t, "objects_per_sec": num_objects / t}
+        t = measure(lambda: data_collector.formatEvents(map_file), repeats)
+        results["parse.formatEvents"] = {"seconds": t, "objects_per_sec": num_objects / t}
+        t = measure(lambda: data_collector.formatOutput(map_file), repeats)
+        results["parse.formatOutput"] = {"seconds": t, "objects_per_sec": num_objects / t}
+
+        # Featurizing (without and with the spectrogram cache)
+        model.feature_cache = FeatureCache(path + "cache/", config.feature_cache_size)
+        t = measure(lambda: convert_to_spectrogram(audio_file, use_cache=False), repeats)
+        results["featurize.uncached"] = {"seconds": t, "audio_sec_per_sec": seconds / t}
+        t = measure(lambda: convert_to_spectrogram(audio_file), repeats)
+        results["featurize.cached"] = {"seconds": t, "audio_sec_per_sec": seconds / t}
+
+        # Dataset loading (spectrograms are cached by now, as they would be in training)
+        dataset = Audio2Map(path, path, path, manifest_path=manifest_path, corpus_path=None)
+        t = measure(lambda: [dataset[i] for i in range(len(dataset))], repeats)
+        results["dataset.getitem"] = {"seconds": t / len(dataset), "samples_per_sec": len(dataset) / t}
+
+        # One training step on a batch of every song
+        encoder = Encoder(0.4).to(model.device)
+        decoder = Decoder(0.4).to(model.device)
+        enc_opt = Adam(encoder.parameters(), lr=1e-4)
+        dec_opt = Adam(decoder.parameters(), lr=1e-4)
+        batch = collate_maps([dataset[i] for i in range(len(dataset))])
+        steps = int(batch[4].sum())
+        t = measure(lambda: train_step(batch, encoder, decoder, enc_opt, dec_opt, masked_mse_loss).item(), repeats)
+        results["train.step"] = {"seconds": t, "samples_per_sec": len(dataset) / t, "decoder_steps_per_sec": steps / t}
+
+        # End-to-end generation with freshly initialized weights
+        torch.save(encoder.state_dict(), path + "encoder.pth")
+        torch.save(decoder.state_dict(), path + "decoder.pth")
+        saved = (osu_beatmap_generator.model_path, config.test_audio_path)
+        osu_beatmap_generator.model_path, config.test_audio_path = path, path
+        try:
+            t = measure(lambda: osu_beatmap_generator.generate_beatmap("0.wav", [5, 4, 8, 9, 1.4, 1], path + "out.osu"), max(1, repeats // 3))
+            t_sparse = measure(lambda: osu_beatmap_generator.generate_beatmap("0.wav", [5, 4, 8, 9, 1.4, 1], path + "out.osu", recall=1.0), max(1, repeats // 3))
+        finally:
+            osu_beatmap_generator.model_path, config.test_audio_path = saved
+        gen_steps = osu_beatmap_generator.song_steps(int(seconds * model.sample_rate / model.hop_length))
+        results["generate.beatmap"] = {"seconds": t, "steps_per_sec": gen_steps / t, "audio_sec_per_sec": seconds / t}
+        results["generate.sparse"] = {"seconds": t_sparse, "audio_sec_per_sec": seconds / t_sparse}
+        model.feature_cache = None
+
+    return results
+
+
+####################################
+# History and baseline
+####################################
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except:
+        return None
+
+
+def make_record(results, size, repeats):
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "size": size,
+        "repeats": repeats,
+        "machine": {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+                    "cpus": os.cpu_count(), "device": str(model.device)},
+        "results": results,
+    }
+
+
+def compare(record, baseline, tolerance):
+    """
+    Compares the seconds of every benchmark against the baseline.
+    @return: The names of the benchmarks that are more than tolerance (a fraction) slower.
+    """
+    regressions = []
+    for name, result in record["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["seconds"]
+        change = result["seconds"] / before - 1
+        flag = "REGRESSION" if change > tolerance else ""
+        print(f"{name:24s} {before:10.4f}s -> {result['seconds']:10.4f}s ({change:+.1%}) {flag}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+# Main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parser, featurizer, dataset, training step and generation")
+    parser.add_argument("--size", choices=sizes.keys(), default="quick", help="The size of the synthetic data")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per benchmark (the median is reported)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown against the baseline (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    record = make_record(run_benchmarks(args.size, args.repeats), args.size, args.repeats)
+    for name, result in record["results"].items():
+        print(f"{name:24s} " + " ".join(f"{k}={v:.4g}" for k, v in result.items()))
+
+    os.makedirs(config.benchmark_path, exist_ok=True)
+    with open(history_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        print("Saved baseline to " + baseline_path)
+    elif os.path.isfile(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["size"] != record["size"]:
+            print(f"Baseline was run with size {baseline['size']}, not comparing.")
+        elif compare(record, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,290 @@
+##########################
+# This file contains the collection catalog.
+# The catalog is an SQLite database with one row per beatmap set id the collector has tried: its status,
+# when it was tried, the hash of the downloaded archive, and every file it produced (with content hashes).
+# Audio files are named by their content hash, so a song used by several mapsets is one file owned by all of them.
+# The collector only draws ids that are not in the catalog yet, and ids that were in flight when a run was
+# interrupted (status "pending") are tried again first, so a new run continues where the last one stopped.
+##########################
+
+
+# Python library imports
+import sqlite3
+import hashlib
+import threading
+import random
+import datetime
+import os
+
+
+# Our imports
+import config
+
+
+# Status of a catalogued map
+PENDING = "pending" # drawn, but the run ended before it finished
+OK = "ok" # extracted; its files are in the artifacts table
+MISSING = "missing" # the API answered 404
+HTTP_ERROR = "http_error" # any other non-200 response (or no response after all retries)
+BAD_ARCHIVE = "bad_archive" # not a zip file, or no difficulty in it could be parsed
+NO_AUDIO = "no_audio" # no .mp3 in the archive
+statuses = (PENDING, OK, MISSING, HTTP_ERROR, BAD_ARCHIVE, NO_AUDIO)
+
+# Highest beatmap set id the collector draws from
+max_map_id = 1000000
+
+# The files produced by each map (a file may belong to several maps)
+artifacts_schema = """
+    CREATE TABLE IF NOT EXISTS artifacts (
+        path TEXT NOT NULL,
+        map_id INTEGER NOT NULL,
+        sha1 TEXT,
+        PRIMARY KEY (path, map_id)
+    );
+    CREATE INDEX IF NOT EXISTS artifacts_map ON artifacts (map_id);
+"""
+
+
+def file_sha1(filename):
+    """
+    Returns the sha1 hex digest of a file.
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class Catalog:
+    """
+    A class that represents the collection catalog. It is safe to use from several threads.
+    """
+    def __init__(self, path=config.catalog_path):
+        """
+        Opens (or creates) the catalog at path.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS maps (
+                id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                http_status INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                first_tried TEXT,
+                last_tried TEXT,
+                archive_sha1 TEXT,
+                difficulties INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS maps_status ON maps (status);
+        """ + artifacts_schema)
+        # Catalogs from before audio was shared between maps allowed one owner per file
+        primary_key = [row[1] for row in self.conn.execute("PRAGMA table_info(artifacts)") if row[5] > 0]
+        if primary_key == ["path"]:
+            self.conn.executescript("""
+                DROP INDEX IF EXISTS artifacts_map;
+                ALTER TABLE artifacts RENAME TO artifacts_old;
+            """ + artifacts_schema + """
+                INSERT INTO artifacts (path, map_id, sha1) SELECT path, map_id, sha1 FROM artifacts_old;
+                DROP TABLE artifacts_old;
+            """)
+        self.conn.commit()
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+            self.conn.commit()
+            return rows
+
+    def begin(self, id):
+        """
+        Marks an id as being tried (status pending).
+        """
+        t = now()
+        self._execute("""
+            INSERT INTO maps (id, status, attempts, first_tried, last_tried) VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET status = excluded.status, attempts = attempts + 1, last_tried = excluded.last_tried
+        """, (int(id), PENDING, t, t))
+
+    def record(self, id, status, http_status=None, archive_sha1=None, artifacts=None, difficulties=0):
+        """
+        Records the outcome of trying an id.
+        @param status: One of the statuses above.
+        @param http_status: The status code of the download (None if there was no response).
+        @param archive_sha1: The hash of the downloaded archive.
+        @param artifacts: A dict of path -> sha1 of every file the map produced (replaces the previous ones).
+        @param difficulties: The number of difficulties extracted.
+        """
+        t = now()
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO maps (id, status, http_status, attempts, first_tried, last_tried, archive_sha1, difficulties)
+                VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET status = excluded.status, http_status = excluded.http_status,
+                    last_tried = excluded.last_tried, archive_sha1 = excluded.archive_sha1, difficulties = excluded.difficulties
+            """, (int(id), status, http_status, t, t, archive_sha1, difficulties))
+            self.conn.execute("DELETE FROM artifacts WHERE map_id = ?", (int(id),))
+            self.conn.executemany("INSERT OR REPLACE INTO artifacts (path, map_id, sha1) VALUES (?, ?, ?)",
+                                  [(path, int(id), sha1) for path, sha1 in (artifacts or {}).items()])
+            self.conn.commit()
+
+    def forget(self, id):
+        """
+        Removes an id and its artifacts from the catalog, so it will be tried again.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM artifacts WHERE map_id = ?", (int(id),))
+            self.conn.execute("DELETE FROM maps WHERE id = ?", (int(id),))
+            self.conn.commit()
+
+    def status(self, id):
+        """
+        Returns the status of an id (None if it has not been tried).
+        """
+        rows = self._execute("SELECT status FROM maps WHERE id = ?", (int(id),))
+        return rows[0][0] if rows else None
+
+    def count(self, status=None):
+        """
+        Returns the number of catalogued ids (with the given status).
+        """
+        if status is None:
+            return self._execute("SELECT COUNT(*) FROM maps")[0][0]
+        return self._execute("SELECT COUNT(*) FROM maps WHERE status = ?", (status,))[0][0]
+
+    def ids(self, status=None):
+        """
+        Returns the catalogued ids (with the given status).
+        """
+        if status is None:
+            return [row[0] for row in self._execute("SELECT id FROM maps ORDER BY id")]
+        return [row[0] for row in self._execute("SELECT id FROM maps WHERE status = ? ORDER BY id", (status,))]
+
+    def archives(self, status=None):
+        """
+        Returns a dict of id -> archive sha1 of the catalogued ids that were downloaded (with the given status).
+        """
+        if status is None:
+            return dict(self._execute("SELECT id, archive_sha1 FROM maps WHERE archive_sha1 IS NOT NULL ORDER BY id"))
+        return dict(self._execute("SELECT id, archive_sha1 FROM maps WHERE archive_sha1 IS NOT NULL AND status = ? ORDER BY id", (status,)))
+
+    def artifacts(self, id=None):
+        """
+        Returns a dict of path -> sha1 of the files produced by a map (or by every map).
+        """
+        if id is None:
+            return dict(self._execute("SELECT path, sha1 FROM artifacts"))
+        return dict(self._execute("SELECT path, sha1 FROM artifacts WHERE map_id = ?", (int(id),)))
+
+    def owners(self, path=None):
+        """
+        Returns a dict of path -> set of ids of the maps that produced it, for every catalogued file (or one file).
+        """
+        if path is None:
+            rows = self._execute("SELECT path, map_id FROM artifacts")
+        else:
+            rows = self._execute("SELECT path, map_id FROM artifacts WHERE path = ?", (path,))
+        owners = {}
+        for path, map_id in rows:
+            owners.setdefault(path, set()).add(map_id)
+        return owners
+
+    def sample(self, max_id=max_map_id):
+        """
+        Yields ids to try (as strings): first the ones left pending by an interrupted run, then random ids
+        that have never been tried. Each id is marked pending right before it is yielded.
+        """
+        for id in self.ids(PENDING):
+            self.begin(id)
+            yield str(id)
+        tried = set(self.ids())
+        while len(tried) < max_id:
+            id = random.randint(1, max_id)
+            if id in tried:
+                continue
+            tried.add(id)
+            self.begin(id)
+            yield str(id)
+
+    def summary(self):
+        """
+        Returns a dict of status -> number of ids.
+        """
+        return dict(self._execute("SELECT status, COUNT(*) FROM maps GROUP BY status"))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def reconcile(catalog, manifest, remove=True):
+    """
+    Brings the data folders, the catalog and the manifest back in sync (e.g. after files were deleted by hand
+    or a run was killed while writing):
+    - difficulties in the manifest from before the catalog existed are added to it as ok,
+    - maps with a missing file are removed everywhere (and forgotten, so they are downloaded again),
+    - files in the data folders that no catalogued map produced are deleted,
+    - manifest entries of maps that are not ok are removed.
+    Each folder is listed once; everything else is a lookup in the catalog.
+    @param remove: Whether to make the changes (otherwise only count what would change).
+    @return: A dict with the number of adopted maps, broken maps, orphan files and stale manifest entries.
+    """
+    folders = (config.audio_path, config.map_path, config.pickle_path)
+    on_disk = {folder + name for folder in folders if os.path.isdir(folder) for name in os.listdir(folder)}
+    owners = catalog.owners()
+    ok = set(catalog.ids(OK))
+
+    # Adopt data collected before the catalog existed
+    adopted = 0
+    by_map = {}
+    for entry in manifest.live():
+        by_map.setdefault(int(entry["map_id"]), []).append(entry)
+    tried = set(catalog.ids())
+    for map_id, entries in by_map.items():
+        if map_id in tried:
+            continue
+        paths = {entries[0]["audio_path"]}
+        for entry in entries:
+            paths.update((entry["pickle_path"], config.map_path + entry["key"] + ".osu"))
+        if all(path in on_disk for path in paths):
+            if remove:
+                catalog.record(map_id, OK, 200, artifacts={path: file_sha1(path) for path in paths}, difficulties=len(entries))
+            for path in paths:
+                owners.setdefault(path, set()).add(map_id)
+            ok.add(map_id)
+            adopted += 1
+
+    # Drop maps whose files are not all there (files shared with maps that are intact are kept)
+    broken = {map_id for path, map_ids in owners.items() if path not in on_disk for map_id in map_ids}
+    for path, map_ids in list(owners.items()):
+        map_ids -= broken
+        if len(map_ids) == 0:
+            if path in on_disk and remove:
+                os.remove(path)
+            on_disk.discard(path)
+            del owners[path]
+    for map_id in broken:
+        ok.discard(map_id)
+        if remove:
+            catalog.forget(map_id)
+
+    # Delete files nobody produced (temporary files of an interrupted write included)
+    orphans = sorted(on_disk - set(owners))
+    if remove:
+        for path in orphans:
+            os.remove(path)
+
+    # Only difficulties of ok maps belong in the manifest
+    stale = [entry["key"] for entry in manifest.live() if int(entry["map_id"]) not in ok]
+    if remove:
+        for key in stale:
+            manifest.remove(key)
+
+    return {"adopted": adopted, "broken": len(broken), "orphans": len(orphans), "stale": len(stale)}
@@ -0,0 +1,174 @@
+##########################
+# This file contains the training checkpoints.
+# A checkpoint holds everything needed to continue training where it stopped: the encoder/decoder weights,
+# the optimizer state, the epoch and batch, the batch sampler's order for the epoch and the RNG states.
+# Checkpoints are copied to the CPU on the training thread (cheap) and written to disk on a background thread,
+# so training does not wait for the disk. Every file is written under a temporary name and renamed when
+# complete, so a job that is killed mid-write leaves the previous checkpoint (and weights) intact.
+#
+# Layout of the checkpoint directory:
+#   checkpoint_<step>.pt    the last keep checkpoints (step = batches trained in total)
+# The weights of the latest checkpoint are also written to encoder.pth/decoder.pth in the model folder,
+# where generation loads them from.
+##########################
+
+
+# Python library imports
+import glob
+import os
+import queue
+import random
+import threading
+import traceback
+import numpy as np
+import torch
+
+
+# Our imports
+import config
+from model import tsprint
+
+
+def to_cpu(obj):
+    """
+    Returns a copy of a (nested) state dict with every tensor copied to the CPU.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomic(obj, filename):
+    """
+    Saves obj with torch.save under a temporary name and renames it to filename once it is complete.
+    """
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filename)
+
+
+def rng_state():
+    """
+    Returns the state of every random number generator used in training.
+    """
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+
+class CheckpointManager:
+    """
+    A class that writes checkpoints on a background thread and keeps the last few of them.
+    """
+    def __init__(self, path=config.checkpoint_path, keep=config.checkpoint_keep, model_path=config.model_path):
+        """
+        @param path: The checkpoint directory.
+        @param keep: The number of checkpoints kept (older ones are deleted).
+        @param model_path: The folder to write the latest encoder.pth/decoder.pth to (None to skip).
+        """
+        self.path = path
+        self.keep = keep
+        self.model_path = model_path
+        os.makedirs(path, exist_ok=True)
+        self.queue = queue.Queue(maxsize=1) # a second save waits for the first one to be written
+        self.thread = threading.Thread(target=self._write, name="checkpoint", daemon=True)
+        self.thread.start()
+
+    def save(self, step, encoder, decoder, encoder_opt, decoder_opt, epoch, batch, sampler=None):
+        """
+        Snapshots the training state and queues it to be written. Returns once the snapshot is taken.
+        @param step: The number of batches trained in total (names the checkpoint).
+        @param epoch: The current epoch (counting from 0).
+        @param batch: The number of batches of the epoch that are done.
+        @param sampler: The batch sampler of the loader (its state_dict is saved if it has one).
+        """
+        checkpoint = to_cpu({
+            "step": step,
+            "epoch": epoch,
+            "batch": batch,
+            "encoder": encoder.state_dict(),
+            "decoder": decoder.state_dict(),
+            "encoder_opt": encoder_opt.state_dict(),
+            "decoder_opt": decoder_opt.state_dict(),
+            "sampler": sampler.state_dict() if hasattr(sampler, "state_dict") else None,
+            "rng": rng_state(),
+        })
+        self.queue.put(checkpoint)
+
+    def _write(self):
+        while True:
+            checkpoint = self.queue.get()
+            if checkpoint is None:
+                self.queue.task_done()
+                return
+            try:
+                save_atomic(checkpoint, os.path.join(self.path, f"checkpoint_{checkpoint['step']:08d}.pt"))
+                if self.model_path is not None:
+                    save_atomic(checkpoint["encoder"], self.model_path + "encoder.pth")
+                    save_atomic(checkpoint["decoder"], self.model_path + "decoder.pth")
+                for old in self.checkpoints()[:-self.keep]:
+                    os.remove(old)
+            except:
+                tsprint(f"ERROR: could not write checkpoint {checkpoint['step']}.")
+                traceback.print_exc()
+            self.queue.task_done()
+
+    def checkpoints(self):
+        """
+        Returns the checkpoint files, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(self.path, "checkpoint_*.pt")))
+
+    def latest(self):
+        """
+        Loads the newest checkpoint that can be read. Returns None if there is none.
+        """
+        for filename in reversed(self.checkpoints()):
+            try:
+                return torch.load(filename, weights_only=False)
+            except:
+                tsprint("ERROR: cannot load checkpoint " + filename + ", trying an older one.")
+        return None
+
+    def flush(self):
+        """
+        Waits until every queued checkpoint has been written.
+        """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def restore(checkpoint, encoder, decoder, encoder_opt, decoder_opt, sampler=None):
+    """
+    Loads a checkpoint into the models, optimizers, batch sampler and RNGs.
+    @return: (epoch, batch, step) to continue from.
+    """
+    encoder.load_state_dict(checkpoint["encoder"])
+    decoder.load_state_dict(checkpoint["decoder"])
+    encoder_opt.load_state_dict(checkpoint["encoder_opt"])
+    decoder_opt.load_state_dict(checkpoint["decoder_opt"])
+    if checkpoint["sampler"] is not None and hasattr(sampler, "load_state_dict"):
+        sampler.load_state_dict(checkpoint["sampler"], checkpoint["batch"])
+    set_rng_state(checkpoint["rng"])
+    return checkpoint["epoch"], checkpoint["batch"], checkpoint["step"]
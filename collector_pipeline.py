@@ -0,0 +1,194 @@
+###########################
+# This file contains the staged collector pipeline: download -> parse -> featurize.
+# Downloads run on threads (see MapDownloader); parsing archives and computing spectrograms are CPU-bound
+# and run on separate process pools. Stages are connected by bounded queues, and each stage only has as many
+# tasks in flight as it has workers, so a slow stage makes the stage before it wait instead of piling up work.
+# Finished tasks are handed to one consumer thread per stage, so a callback that blocks (e.g. on a full queue of
+# the next stage) holds up that stage's workers, never the process pool itself.
+# The pipeline does not know where maps are stored: the catalog, the manifest and the functions that extract,
+# store and record maps are passed in by the collector (see data_collector.collect_data).
+###########################
+
+
+# Python library imports
+import queue
+import threading
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Our imports
+import config
+import metrics
+from catalog import BAD_ARCHIVE
+
+
+def featurize(audio_path, sha1=None):
+    """
+    Computes the spectrogram of an audio file so it is in the feature cache before training.
+    @param sha1: The content hash of the audio (see manifest.make_entry).
+    """
+    import model # (imported here, so the parse processes do not load librosa)
+    return model.convert_to_spectrogram(audio_path, sha1=sha1) is not None
+
+
+class Stage:
+    """
+    A pipeline stage that takes items off a bounded queue and runs fn(*item) on a process pool.
+    At most workers tasks are submitted at a time. For every finished task, on_done(item, result) is called on the
+    stage's consumer thread, or on_error(item) if the task raised (or on_done did).
+    """
+    def __init__(self, name, fn, workers, queue_size, on_done, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.queue = queue.Queue(queue_size)
+        self.results = queue.Queue() # (item, future, start) of finished tasks (at most workers at a time)
+        self.slots = threading.BoundedSemaphore(workers)
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self.on_done = on_done
+        self.on_error = on_error
+        self.workers = workers
+        self.thread = threading.Thread(target=self._dispatch, name=name, daemon=True)
+        self.consumer = threading.Thread(target=self._consume, name=name + "-results", daemon=True)
+        self.thread.start()
+        self.consumer.start()
+
+    def put(self, item):
+        """
+        Queues an item (blocks while the queue is full).
+        """
+        self.queue.put(item)
+
+    def close(self):
+        """
+        Waits for every queued item to be processed and shuts the pool down.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.results.put(None)
+        self.consumer.join()
+        self.pool.shutdown()
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.slots.acquire()
+            # A task is submitted only when a worker is free, so submit -> done is the time it ran
+            start = time.perf_counter()
+            future = self.pool.submit(self.fn, *item)
+            # (the pool's done callback only hands the task over; the consumer thread does the work)
+            future.add_done_callback(lambda f, item=item, start=start: self.results.put((item, f, start)))
+        # Every slot is released only after its on_done has run, so this waits for all of them
+        for _ in range(self.workers):
+            self.slots.acquire()
+
+    def _consume(self):
+        while True:
+            task = self.results.get()
+            if task is None:
+                return
+            self._finish(*task)
+
+    def _finish(self, item, future, start):
+        metrics.histogram("pipeline_task_seconds", "Time to run one task of a collector stage", stage=self.name).observe(time.perf_counter() - start)
+        metrics.gauge("pipeline_queue_items", "Items waiting in front of a collector stage", stage=self.name).set(self.queue.qsize())
+        try:
+            self.on_done(item, future.result())
+        except:
+            from model import tsprint # (imported here, so the parse processes do not load librosa)
+            tsprint(f"Error in {self.name} stage for {item[0]}")
+            traceback.print_exc()
+            if self.on_error is not None:
+                try:
+                    self.on_error(item)
+                except:
+                    traceback.print_exc()
+        finally:
+            self.slots.release()
+
+
+class CollectorPipeline:
+    """
+    A class that downloads, parses and featurizes maps concurrently.
+    """
+    def __init__(self, downloader, catalog, manifest, extract, store, record, log=None, parse_workers=config.parse_workers,
+                 featurize_workers=config.featurize_workers, queue_size=config.pipeline_queue_size, featurize=True):
+        """
+        @param downloader: The MapDownloader to use.
+        @param catalog: The Catalog maps are recorded in.
+        @param manifest: The Manifest extracted difficulties are added to.
+        @param extract: extract(id, content, update_manifest) -> (status, manifest entries, artifacts), run in the
+        parse processes (see data_collector.extract_map).
+        @param store: store(content) -> sha1 of the archive, called before it is parsed (see data_collector.store_archive).
+        @param record: record(id, http_status, archive_sha1, result, catalog) records the outcome of a map
+        (see data_collector.record_map).
+        @param log: Prints a progress message (defaults to model.tsprint).
+        @param parse_workers: The number of processes parsing archives.
+        @param featurize_workers: The number of processes computing spectrograms.
+        @param queue_size: The number of items that may wait between two stages.
+        @param featurize: Whether to compute spectrograms of the downloaded audio.
+        """
+        self.downloader = downloader
+        self.catalog = catalog
+        self.manifest = manifest
+        self.extract = extract
+        self.store = store
+        self.record = record
+        if log is None:
+            from model import tsprint as log
+        self.log = log
+        self.parse_workers = parse_workers
+        self.featurize_workers = featurize_workers
+        self.queue_size = queue_size
+        self.featurize = featurize
+
+    def run(self, ids):
+        """
+        Downloads, parses and featurizes every map in ids. Returns once every stage has finished.
+        """
+        featurize_stage = None
+        if self.featurize:
+            featurize_stage = Stage("featurize", featurize, self.featurize_workers, self.queue_size, self.featurized)
+
+        archive_sha1s = {} # id -> hash of the archive being parsed
+        def parsed(item, result):
+            # Record the map here, so only this process writes to the manifest and the catalog
+            id, content, _ = item
+            entries = result[1]
+            for entry in entries:
+                self.manifest.add(entry)
+            self.record(id, 200, archive_sha1s[id], result, self.catalog)
+            del archive_sha1s[id]
+            if len(entries) > 0 and featurize_stage is not None:
+                featurize_stage.put((entries[0]["audio_path"], entries[0]["audio_sha1"]))
+
+        def failed(item):
+            # The parse process died or the map could not be recorded: record it as a bad archive
+            id = item[0]
+            if id in archive_sha1s:
+                self.record(id, 200, archive_sha1s.pop(id), (BAD_ARCHIVE, [], {}), self.catalog)
+
+        parse_stage = Stage("parse", self.extract, self.parse_workers, self.queue_size, parsed, failed)
+
+        def downloaded(id, status, content):
+            if status != 200 or content is None:
+                self.log("Error downloading map with ID " + id + " (status " + str(status) + ")")
+                self.record(id, status, None, None, self.catalog)
+                return
+            # Keep the archive before parsing it, so the map can be rebuilt without downloading it again
+            archive_sha1s[id] = self.store(content)
+            parse_stage.put((id, content, False))
+
+        try:
+            self.downloader.run(ids, downloaded)
+        finally:
+            parse_stage.close()
+            if featurize_stage is not None:
+                featurize_stage.close()
+
+    def featurized(self, item, ok):
+        if not ok:
+            self.log("Could not compute the spectrogram of " + item[0])
@@ -25,4 +25,82 @@ model_path = "models/"
 log_path = "logs/"
 
 # API link to the osu! API
-api_link = "https://beatconnect.io/b/"
\ No newline at end of file
+api_link = "https://beatconnect.io/b/"
+
+# Path to the on-disk spectrogram cache (set to None to disable caching)
+feature_cache_path = "cache/features/"
+
+# Maximum size of the spectrogram cache in bytes (least recently used entries are evicted first)
+feature_cache_size = 20 * 1024**3
+
+# Path to the dataset manifest (one JSON entry per difficulty)
+manifest_path = "manifest.jsonl"
+
+# Map downloader settings
+download_concurrency = 8 # number of downloads in flight at once
+download_rate_limit = 4 # maximum requests per second (None for no limit)
+download_retries = 3 # retries per map on connection errors, timeouts, 429 and 5xx responses
+download_timeout = 30 # seconds
+
+# Collector pipeline settings (download -> parse -> featurize)
+parse_workers = 4 # processes parsing downloaded archives
+featurize_workers = 2 # processes computing spectrograms for the feature cache
+pipeline_queue_size = 16 # items waiting between two stages before the earlier stage blocks
+
+# Path to the packed training corpus (see corpus.py)
+corpus_path = "corpus/"
+
+# Approximate size of one corpus shard in bytes
+corpus_shard_size = 2 * 1024**3
+
+# Path to the collection catalog (every map id the collector has tried, see catalog.py)
+catalog_path = "catalog.db"
+
+# Path to the store of downloaded archives (see archive_store.py); set to None to discard archives after extraction
+archive_path = "archives/"
+
+# Maximum size of the archive store in bytes (least recently used archives are evicted first)
+archive_store_size = 50 * 1024**3
+
+# zlib level the archives are stored with (0 = uncompressed, 9 = smallest; the audio inside barely compresses)
+archive_compression = 6
+
+# Path to the benchmark history and baseline (see benchmark.py)
+benchmark_path = "benchmarks/"
+
+# Metrics export (see metrics.py); set a path to None to skip that format
+metrics_prometheus_path = log_path + "metrics.prom" # overwritten on every export
+metrics_json_path = log_path + "metrics.jsonl" # one snapshot appended per export
+metrics_interval = 30 # seconds between exports while collecting/training
+
+# Generation server settings (see generation_server.py)
+server_host = "127.0.0.1"
+server_port = 8700
+server_workers = 2 # worker threads running jobs
+server_max_batch = 8 # maximum number of jobs generated together
+server_batch_wait = 0.05 # seconds a worker waits for more jobs to batch with
+server_job_history = 1000 # finished jobs kept for status requests
+server_output_path = "outputs/" # folder the beatmaps of jobs are written to (job output paths are relative to it)
+
+# Training data loader settings (see train.make_loader)
+loader_workers = 4 # worker processes decoding and featurizing songs ahead of training (0 = in the training process)
+loader_prefetch = 2 # batches each worker keeps ready
+
+# Windowed training samples (see model.WindowBatchSampler); set window_length to None to train on whole songs
+window_length = 20000 # ms of song per training sample
+window_stride = 5000 # ms between possible window starts
+window_crops = 4 # windows drawn from each song per epoch
+
+# Training checkpoints (see checkpoint.py)
+checkpoint_path = model_path + "checkpoints/"
+checkpoint_keep = 3 # checkpoints kept on disk (older ones are deleted)
+checkpoint_interval = 10 # batches between checkpoints
+split_seed = 0 # seed of the train/test split, so a resumed run trains on the same songs
+
+# Time grid of the training targets and generation (see model.target_grid): "ms" for one decoder step per
+# millisecond (10 ms when generating), "frame" for one step per spectrogram frame (~46 ms) with the exact
+# offset into the frame predicted as an extra feature. Models must be retrained after changing this.
+target_grid = "ms"
+
+# Sparse decoding (see osu_beatmap_generator.generate_sparse)
+onset_margin = 1 # frames around each onset peak the decoder also runs on
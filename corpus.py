@@ -0,0 +1,267 @@
+##########################
+# This file contains the packed training corpus.
+# The spectrograms and event tables of every difficulty in the manifest are packed into a few large shard
+# files of raw float32/event rows, with a JSON index of where each difficulty's rows start. Shards are opened
+# as memory maps, so reading a sample is a slice of a file that is already open (no per-sample open or unpickle).
+#
+# Layout of a corpus directory:
+#   index.json              shard sizes and one entry per difficulty (offsets into the shards)
+#   shard_<n>.features      float32 spectrogram frames (frames x n_bins), songs back to back
+#   shard_<n>.events        event table rows (see beatmap_events.event_dtype), difficulties back to back
+# All difficulties of a song share one copy of its spectrogram.
+# The index records the spectrogram parameters and target grid the corpus was packed with; a corpus packed with
+# other settings, or older than the manifest, is not used (see Corpus.check). A corpus is packed into a
+# temporary directory and swapped in once it is complete, so readers never see a half-written one.
+##########################
+
+
+# Python library imports
+import json
+import os
+import shutil
+import traceback
+import numpy as np
+
+
+# Our imports
+import config
+from beatmap_events import event_dtype, load_events, events_from_dense, get_length
+
+
+# Bump this when the shard layout changes
+corpus_version = 1
+
+
+def corpus_params():
+    """
+    Returns the settings a corpus depends on: the spectrogram parameters and the target grid (see model.py).
+    """
+    import model
+    return {"sr": model.sample_rate, "n_bins": model.n_bins, "bins_per_octave": model.bins_per_octave,
+            "hop_length": model.hop_length, "target_grid": model.target_grid}
+
+
+class Corpus:
+    """
+    A class that reads a packed corpus. Shards are memory-mapped on first use (in each process).
+    """
+    def __init__(self, path=config.corpus_path):
+        """
+        Loads the index of the corpus at path.
+        """
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index["version"] != corpus_version:
+            raise ValueError(f"Corpus at {path} has version {index['version']}, expected {corpus_version}. Please repack it.")
+        self.n_bins = index["n_bins"]
+        self.params = index["params"]
+        self.shards = index["shards"]
+        self.entries = index["entries"]
+        self.index = {entry["key"]: i for i, entry in enumerate(self.entries)}
+        self.maps = {} # (shard, kind) -> memmap
+
+    def __getstate__(self):
+        # Worker processes open their own memory maps
+        state = self.__dict__.copy()
+        state["maps"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check(self, manifest_path=config.manifest_path):
+        """
+        Returns why the corpus cannot be used with the current settings, or None if it can: it was packed with
+        other spectrogram parameters or another target grid, or the manifest changed after it was packed.
+        @param manifest_path: The manifest the corpus was packed from (None to skip that check).
+        """
+        params = corpus_params()
+        if self.params != params:
+            return f"It was packed with {self.params}, the current settings are {params}. Please repack it."
+        if manifest_path is not None and os.path.isfile(manifest_path) and \
+                os.path.getmtime(manifest_path) > os.path.getmtime(os.path.join(self.path, "index.json")):
+            return f"{manifest_path} changed after it was packed. Please repack it."
+
+    def _open(self, shard, kind):
+        if (shard, kind) not in self.maps:
+            info = self.shards[shard]
+            filename = os.path.join(self.path, info["name"] + "." + kind)
+            if kind == "features":
+                self.maps[(shard, kind)] = np.memmap(filename, dtype=np.float32, mode="r", shape=(info["frames"], self.n_bins))
+            else:
+                self.maps[(shard, kind)] = np.memmap(filename, dtype=event_dtype, mode="r", shape=(info["events"],))
+        return self.maps[(shard, kind)]
+
+    def features(self, idx):
+        """
+        Returns the spectrogram of a sample as a read-only (frames, n_bins) view of its shard.
+        """
+        entry = self.entries[idx]
+        return self._open(entry["shard"], "features")[entry["frame_offset"]:entry["frame_offset"] + entry["frames"]]
+
+    def events(self, idx):
+        """
+        Returns the event table of a sample as a read-only view of its shard.
+        """
+        entry = self.entries[idx]
+        return self._open(entry["shard"], "events")[entry["event_offset"]:entry["event_offset"] + entry["events"]]
+
+
+class ShardWriter:
+    """
+    Appends songs to shard files, starting a new shard when the current one reaches shard_size bytes.
+    Shards are written under a temporary name and renamed once they are complete.
+    """
+    def __init__(self, path, shard_size):
+        self.path = path
+        self.shard_size = shard_size
+        self.shards = []
+        self.files = None
+
+    def _name(self, shard):
+        return os.path.join(self.path, self.shards[shard]["name"])
+
+    def _start(self):
+        self.shards.append({"name": f"shard_{len(self.shards):05d}", "frames": 0, "events": 0, "bytes": 0})
+        name = self._name(len(self.shards) - 1)
+        self.files = (open(name + ".features.tmp", "wb"), open(name + ".events.tmp", "wb"))
+
+    def _finish(self):
+        if self.files is None:
+            return
+        name = self._name(len(self.shards) - 1)
+        for f, kind in zip(self.files, ("features", "events")):
+            f.close()
+            os.replace(name + "." + kind + ".tmp", name + "." + kind)
+        self.files = None
+
+    def write(self, features, events_list):
+        """
+        Writes a song's spectrogram (frames, n_bins) and the event tables of its difficulties.
+        @return: (shard, frame offset, [event offset of each difficulty])
+        """
+        size = features.nbytes + sum(events.nbytes for events in events_list)
+        if self.files is None or (self.shards[-1]["bytes"] > 0 and self.shards[-1]["bytes"] + size > self.shard_size):
+            self._finish()
+            self._start()
+        shard = self.shards[-1]
+        frame_offset = shard["frames"]
+        self.files[0].write(np.ascontiguousarray(features, dtype=np.float32).tobytes())
+        shard["frames"] += features.shape[0]
+
+        event_offsets = []
+        for events in events_list:
+            event_offsets.append(shard["events"])
+            self.files[1].write(np.ascontiguousarray(events, dtype=event_dtype).tobytes())
+            shard["events"] += len(events)
+        shard["bytes"] += size
+        return len(self.shards) - 1, frame_offset, event_offsets
+
+    def close(self):
+        self._finish()
+        return [{"name": shard["name"], "frames": shard["frames"], "events": shard["events"]} for shard in self.shards]
+
+
+def read_events(filename):
+    """
+    Reads the event table of a difficulty from an .npz file (or converts an old .pkl file).
+    """
+    if filename.endswith(".npz"):
+        return load_events(filename)[0]
+    from model import get_pkl
+    out = get_pkl(filename)
+    if out is None:
+        raise ValueError("cannot load " + filename)
+    return events_from_dense(out[0].to_dense().numpy())
+
+
+def pack_corpus(entries, path=config.corpus_path, shard_size=config.corpus_shard_size):
+    """
+    Packs the spectrograms and targets of manifest entries into a corpus.
+    Spectrograms come from the feature cache (and are computed if they are missing).
+    The corpus is packed into <path>.tmp and then swapped in for path, so a corpus that is still being packed is
+    never read. Processes that have the old corpus open keep reading its (deleted) shards.
+    @param entries: The manifest entries to pack.
+    @param path: The corpus directory.
+    @param shard_size: The approximate size of one shard in bytes.
+    @return: The number of difficulties packed.
+    """
+    import model
+    path = os.path.normpath(path)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True) # left over from an interrupted run
+    os.makedirs(tmp_path)
+
+    # Group difficulties by song (across mapsets, by the content hash of the audio), so every song is featurized
+    # and stored once
+    songs = {}
+    for entry in entries:
+        songs.setdefault(entry.get("audio_sha1") or entry["audio_path"], []).append(entry)
+
+    writer = ShardWriter(tmp_path, shard_size)
+    index_entries = []
+    for group in songs.values():
+        audio_path = group[0]["audio_path"]
+        S = model.convert_to_spectrogram(audio_path, sha1=group[0].get("audio_sha1"))
+        if S is None:
+            model.tsprint("Skipping " + audio_path + " (no spectrogram)")
+            continue
+
+        packed = []
+        for entry in group:
+            try:
+                packed.append((entry, read_events(entry["pickle_path"])))
+            except:
+                model.tsprint("Skipping " + entry["key"] + " (cannot load targets)")
+                traceback.print_exc()
+        if len(packed) == 0:
+            continue
+
+        shard, frame_offset, event_offsets = writer.write(S.T, [events for _, events in packed])
+        for (entry, events), event_offset in zip(packed, event_offsets):
+            index_entries.append({
+                "key": entry["key"],
+                "map_id": entry["map_id"],
+                "diff_index": entry["diff_index"],
+                "difficulty": entry["difficulty"],
+                "length": get_length(events),
+                "shard": shard,
+                "frame_offset": frame_offset,
+                "frames": int(S.shape[1]),
+                "event_offset": event_offset,
+                "events": len(events),
+            })
+
+    index = {
+        "version": corpus_version,
+        "n_bins": model.n_bins,
+        "params": corpus_params(),
+        "shards": writer.close(),
+        "entries": index_entries,
+    }
+    with open(os.path.join(tmp_path, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f)
+
+    # Swap the new corpus in (a directory can only be renamed onto an empty one, so the old one is moved away first)
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    model.tsprint(f"Packed {len(index_entries)} difficulties ({len(index['shards'])} shards) into {path}")
+    return len(index_entries)
+
+
+# Main
+if __name__ == "__main__":
+    import argparse
+    from manifest import Manifest
+
+    parser = argparse.ArgumentParser(description="Pack the difficulties in the manifest into a sharded corpus")
+    parser.add_argument("output", nargs="?", default=config.corpus_path, help="The corpus directory")
+    parser.add_argument("--shard-size", type=int, default=config.corpus_shard_size, help="Approximate shard size in bytes")
+    args = parser.parse_args()
+
+    pack_corpus(Manifest(config.manifest_path).live(), args.output, args.shard_size)
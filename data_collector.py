@@ -1,33 +1,48 @@
 ###########################
 # This script will collect osu! maps from an osu! API (beatconnect.io) and extract them.
-# The maps are then processed and saved in a pickle file. (pytorch tensors)
+# The maps are then processed and saved as event tables (.npz, see beatmap_events.py) in the pickle folder.
 # The pickle files are used to train the model.
+# Audio is stored once per distinct song, named by the sha1 of its contents (see audio_filename), so mapsets that
+# use the same mp3 share one audio file, one cached spectrogram and one copy in the packed corpus.
+# Downloaded archives are kept in the archive store (see archive_store.py), so `python data_collector.py reprocess`
+# can rebuild the maps, pickles and audio from them without downloading anything again.
 # The directories to each section (audio, maps, pickles) can be edited in the config file. 
 ###########################
 
 
 # Python library imports
-import requests
 import zipfile
 import io
 import os
-import random
 import datetime
+import time
 import torch
-import numpy as np
-import librosa
 import pickle
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
 
 # Our imports
 import config #config file
+from manifest import Manifest, make_entry
+from downloader import MapDownloader
+from archive_store import ArchiveStore
+from catalog import Catalog, reconcile, file_sha1, PENDING, OK, MISSING, HTTP_ERROR, BAD_ARCHIVE, NO_AUDIO
+import collector_pipeline
+import metrics
+import osu_parser
+from beatmap_events import save_events, load_events, get_length, densify, pad_slider_points
 
 
 extract_path_maps = config.map_path
 extract_path_audio = config.audio_path
 extract_path_pickles = config.pickle_path
 
+manifest = None # created on first use
+downloader = None # created on first use
+collection_catalog = None # created on first use
+archive_store = None # created on first use
+
 ##################
 # Helper Functions
 ##################
@@ -62,28 +77,98 @@ def parse_difficulty(lines):
 
     return difficulty
 
-def remove_osu_map_files(id):
+def get_downloader() -> MapDownloader:
     """
-    Given an map id, removes all the files related to that map.
+    Returns the shared map downloader.
     """
+    global downloader
+    if downloader is None:
+        downloader = MapDownloader(config.api_link)
+    return downloader
+
+def get_manifest() -> Manifest:
+    """
+    Returns the shared dataset manifest.
+    """
+    global manifest
+    if manifest is None:
+        manifest = Manifest(config.manifest_path)
+    return manifest
+
+def get_catalog() -> Catalog:
+    """
+    Returns the shared collection catalog.
+    """
+    global collection_catalog
+    if collection_catalog is None:
+        collection_catalog = Catalog(config.catalog_path)
+    return collection_catalog
+
+def get_archive_store() -> ArchiveStore:
+    """
+    Returns the shared archive store, or None if keeping archives is disabled in the config.
+    """
+    global archive_store
+    if archive_store is None and config.archive_path is not None:
+        archive_store = ArchiveStore(config.archive_path, config.archive_store_size, config.archive_compression)
+    return archive_store
+
+def store_archive(content):
+    """
+    Keeps a downloaded archive in the archive store (if it is enabled).
+    @return: The sha1 hex digest of the archive.
+    """
+    store = get_archive_store()
+    if store is None:
+        return hashlib.sha1(content).hexdigest()
+    return store.put(content)
+
+def audio_filename(sha1):
+    """
+    Returns the canonical path of the audio file with the given content hash.
+    """
+    return extract_path_audio + sha1 + ".mp3"
+
+def find_audio(id):
+    """
+    Returns (path, content hash) of a map's audio file: the one the catalog recorded for it, or <id>.mp3 from
+    before the catalog existed (its hash is then None). Returns None if the map has no audio file.
+    """
+    for path, sha1 in get_catalog().artifacts(id).items():
+        if path.startswith(extract_path_audio) and os.path.isfile(path):
+            return path, sha1
+    if os.path.isfile(extract_path_audio + id + ".mp3"):
+        return extract_path_audio + id + ".mp3", None
+
+def add_to_manifest(id, count, difficulty, length, m=None, ext=".npz", audio_path=None, audio_sha1=None):
+    """
+    Records a processed difficulty (<id>_<count>) in the dataset manifest.
+    @param ext: The extension of the target file (.npz event table, or .pkl for the old format).
+    @param audio_path: The path to the audio file (defaults to <id>.mp3 from before audio was deduplicated).
+    @param audio_sha1: The content hash of the audio file.
+    """
+    (m if m is not None else get_manifest()).add(make_entry(id, count,
+                                  audio_path or extract_path_audio + id + ".mp3",
+                                  extract_path_pickles + id + "_" + str(count) + ext,
+                                  difficulty, length, audio_sha1))
+
+def write_atomic(path, src):
+    """
+    Copies a file-like object to path through a temporary file, so path is either complete or absent.
+    @return: The sha1 hex digest of the contents.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" # several workers may write the same audio
+    h = hashlib.sha1()
     try:
-        count = 0 #use a counter since there may be multiple .osu files.
-        while os.path.isfile(extract_path_maps + id + "_" + str(count) + ".osu"):
-            os.remove(extract_path_maps + id + "_" + str(count) + ".osu")
-            count += 1
-    except:
-        tsprint("Error removing osu map with ID " + id)
-    try:
-        count = 0 #use a counter since there may be multiple .pkl files.
-        while os.path.isfile(extract_path_pickles + id + "_" + str(count) + ".pkl"):
-            os.remove(extract_path_pickles + id + "_" + str(count) + ".pkl")
-            count += 1
-    except:
-        tsprint("Error removing pickle with ID " + id)
-    try:
-        if os.path.isfile(extract_path_audio + id + ".mp3"): os.remove(extract_path_audio + id + ".mp3")
-    except:
-        tsprint("Error removing audio with ID " + id)
+        with open(tmp_path, "wb") as f:
+            for block in iter(lambda: src.read(1 << 20), b""):
+                h.update(block)
+                f.write(block)
+        os.replace(tmp_path, path)
+        return h.hexdigest()
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
 
 def get_curve_type(letter: str) -> int:
     """
@@ -113,14 +198,21 @@ def get_curve_points(curvePts):
 def getOutput(filename):
     """
     Given a file, parse it and return each of its hitobjects/sliders in a list format.
+    NOTE: This is the line-by-line reference parser; the collector uses osu_parser (same output, much faster).
     """
-    # Open the file
-    f = open(filename, 'r', encoding='utf-8')
+    with open(filename, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
 
-    # Go to the file position where HitObjects start
-    while("HitObject" not in f.readline()):
-        pass
+    # Go to the line where HitObjects start
+    start = 0
+    while start < len(lines) and "HitObject" not in lines[start]:
+        start += 1
+    return parse_hitobjects(lines[start + 1:])
 
+def parse_hitobjects(lines):
+    """
+    Given the lines of a [HitObjects] section, return each of its hitobjects/sliders in a list format.
+    """
     # format the objects as two ndarrays, one for all attribs except sliderpts, and one for only sliderpts
     target = []
     sliderpts = []
@@ -132,7 +224,9 @@ def getOutput(filename):
     # (hit sample ommitted from ends + edge sounds and sets)
     ######################
 
-    for line in f:
+    for line in lines:
+        if not line.strip():
+            continue
         objData = line.split(',')
         if(int(objData[3]) & 0b00000010):
             # Slider data
@@ -141,7 +235,7 @@ def getOutput(filename):
             sliderpts.append(get_curve_points(sliderData[1:]))
 
             try:
-                objData = [int(x) for x in objData[:4]] + [curveType, int(objData[6]), float(objData[7][:-1]), 0]
+                objData = [int(x) for x in objData[:4]] + [curveType, int(objData[6]), float(objData[7]), 0]
             except:
                 tsprint("ERROR: Insufficient data for slider.")
                 return [], []
@@ -152,142 +246,353 @@ def getOutput(filename):
             #Hit Circle Data
             objData = [int(x) for x in objData[:4]] + [get_curve_type('B'), 0, 0, 0] # Add dummy data for non-slider attribs
         target.append(objData)
-    f.close()
     return target, sliderpts
 
-def formatOutput(filename):
-    # Get the output
-    target, sliderpts = getOutput(filename)
-    pos = 0
-    newTarget = [] 
-    if len(target) == 0 or len(target[0]) == 0:
-        tsprint("ERROR: Insufficient data for hitpoints.")
+def parse_osu(lines):
+    """
+    Parses the lines of a full .osu file in one pass.
+    Only the RELEVANT sections (Difficulty, TimingPoints, HitObjects) are kept in the cropped file.
+    @return: (cropped lines, difficulty vector, audio file name, (events, offsets, values)),
+             or None if the map is missing difficulty stats or hit objects.
+    """
+    sections = {}
+    section = None
+    for line in lines:
+        if line.startswith("["):
+            section = line.strip()[1:-1]
+            sections[section] = [line]
+        elif section is not None:
+            sections[section].append(line)
+
+    cropped = [line for name in ("Difficulty", "TimingPoints", "HitObjects") for line in sections.get(name, [])]
+    difficulty = parse_difficulty(sections.get("Difficulty", []))
+    if -1 in difficulty:
+        tsprint("ERROR: Not a valid osu! map due to insufficient stats.")
         return
-    for t in range(0, target[-1][2] + 1):
-        if(pos < len(target) and target[pos][2] == t):
-            newTarget.append(target[pos])
-            newTarget[-1][2] = 1
-            pos += 1
-        else:
-            newTarget.append([0,0,0,0,0,0,0,0])
 
+    audio_name = None
+    for line in sections.get("General", []):
+        if line.startswith("AudioFilename"):
+            audio_name = line.split(":", 1)[1].strip()
+
+    events, offsets, values = osu_parser.parse_hitobjects("".join(sections.get("HitObjects", [])[1:]))
+    if len(events) == 0:
+        tsprint("ERROR: Insufficient data for hitpoints.")
+        return
+    return cropped, difficulty, audio_name, (events, offsets, values)
 
-    maxlen = max([len(x) for x in sliderpts]) if len(sliderpts) > 0 else 0
-    for i in range(len(sliderpts)):
-        while(len(sliderpts[i]) < maxlen):
-            sliderpts[i].append([0,0])
+def formatEvents(filename):
+    """
+    Given a file, parse it and return its hit objects as an event table with ragged slider points.
+    @return: (events, offsets, values) (see beatmap_events), or None if the map has no hit objects.
+    """
+    events, offsets, values, _ = osu_parser.parse_file(filename)
+    if len(events) == 0:
+        tsprint("ERROR: Insufficient data for hitpoints.")
+        return
+    return events, offsets, values
 
-    newTarget = torch.tensor(np.stack(tuple(newTarget), axis=0)).to_sparse_csr() 
-    if len(sliderpts) > 0:  
-        sliderpts = torch.tensor(np.stack(tuple(sliderpts), axis=0)).to_sparse()
-    else: 
-        sliderpts = torch.tensor([]).to_sparse()
-    
+def formatOutput(filename):
+    """
+    Given a file, return its dense per-millisecond target rows and padded slider points as sparse tensors.
+    NOTE: The training data is stored as event tables (see formatEvents); this is kept for the old pickle format.
+    """
+    out = formatEvents(filename)
+    if out is None:
+        return
+    events, offsets, values = out
+    newTarget = torch.tensor(densify(events)).to_sparse_csr()
+    sliderpts = torch.tensor(pad_slider_points(events, offsets, values))
+    sliderpts = sliderpts.to_sparse() if sliderpts.shape[0] > 0 else torch.tensor([]).to_sparse()
     return newTarget, sliderpts
 
 
-def process_file(file):
-    if file.endswith(".osu"):
-        tsprint("Starting file processing for " + file)
-        out = formatOutput(extract_path_maps + file)
-        pickle.dump(out, open(extract_path_pickles + file[:-4] + ".pkl", "wb"))
-        tsprint("Finished file processing for " + file)
+def build_manifest(m=None):
+    """
+    Scans the pickle directory and adds every difficulty that is not in the manifest yet.
+    Only difficulties with a map file, an audio file and a complete [Difficulty] section are added.
+    @param m: The manifest to add to (defaults to the one in the config).
+    """
+    m = m if m is not None else get_manifest()
+    added = 0
+    for name in sorted(os.listdir(extract_path_pickles)):
+        key, ext = os.path.splitext(name)
+        if ext not in (".npz", ".pkl") or key in m:
+            continue
+        if ext == ".pkl" and os.path.isfile(extract_path_pickles + key + ".npz"):
+            continue # prefer the event table
+        id, count = key.split("_", 1)
+        audio = find_audio(id)
+        if not os.path.isfile(extract_path_maps + key + ".osu") or audio is None:
+            continue
+        try:
+            with open(extract_path_maps + key + ".osu", "r", encoding="utf-8") as f:
+                lines = f.readlines()
+            # (cropped maps start at [Difficulty]; full ones have other sections before it)
+            start = next((i for i, line in enumerate(lines) if line.startswith("[Difficulty]")), 0)
+            difficulty = parse_difficulty(lines[start:])
+            if -1 in difficulty:
+                continue
+            if ext == ".npz":
+                length = get_length(load_events(extract_path_pickles + name)[0])
+            else:
+                with open(extract_path_pickles + name, "rb") as f:
+                    out = pickle.load(f)
+                if out is None:
+                    continue
+                length = out[0].shape[0]
+            add_to_manifest(id, count, difficulty, length, m, ext, *audio)
+            added += 1
+        except:
+            tsprint("Error adding " + name + " to the manifest")
+            traceback.print_exc()
+    tsprint(f"Added {added} difficulties to the manifest ({len(m)} total).")
+    return m
+
+def downloadMap(id, downloader=None):
+    """
+    Given a map id, try to download it from the osu! API and extract it.
+    @param downloader: The MapDownloader to use (defaults to a shared one).
+    """
+    get_catalog().begin(id)
+    status, content = (downloader or get_downloader()).fetch(id)
+    handle_download(id, status, content)
 
-def downloadMap(id):
+def handle_download(id, status, content):
+    """
+    Handles the result of a download: stores and extracts the archive if the request succeeded, and records the
+    outcome in the catalog.
+    """
+    if status != 200 or content is None:
+        tsprint("Error downloading map with ID " + id + " (status " + str(status) + ")")
+        record_map(id, status)
+        return
+    archive_sha1 = store_archive(content)
+    with metrics.timer("pipeline_task_seconds", "Time to run one task of a collector stage", stage="parse"):
+        result = extract_map(id, content)
+    record_map(id, status, archive_sha1, result)
+
+def record_map(id, http_status, archive_sha1=None, result=None, c=None):
+    """
+    Records the outcome of trying a map in the catalog.
+    @param http_status: The status code of the download.
+    @param archive_sha1: The hash of the downloaded archive (if the download succeeded).
+    @param result: What extract_map returned for the archive.
+    @param c: The catalog to record in (defaults to the shared one).
     """
-    Given a map id, try to download it from the osu! API.
+    c = c if c is not None else get_catalog()
+    if http_status != 200 or archive_sha1 is None:
+        status = MISSING if http_status == 404 else HTTP_ERROR
+        metrics.counter("collector_maps_total", "Maps tried by outcome", status=status).inc()
+        c.record(id, status, http_status)
+        return
+    status, entries, artifacts = result
+    metrics.counter("collector_maps_total", "Maps tried by outcome", status=status).inc()
+    metrics.counter("collector_difficulties_total", "Difficulties extracted").inc(len(entries))
+    c.record(id, status, http_status, archive_sha1, artifacts, len(entries))
+
+def extract_map(id, content, update_manifest=True):
+    """
+    Given a map id and its downloaded archive (.osz), extract and process its maps and audio.
+    Each archive member is read straight from memory and parsed once; every file is written once, atomically,
+    so a failure never leaves a partial map, target or audio file behind.
     NOTE: This function will only extract the RELEVANT data in an .osu file (HitObjects, Difficulty, TimingPoints).
+    @param update_manifest: Whether to add the difficulties to the manifest (worker processes leave this to the caller).
+    @return: (catalog status, manifest entries of the extracted difficulties, dict of written file -> sha1)
     """
     try:
-        try:
-            response = requests.get("https://beatconnect.io/b/" + id)
-            if response.status_code != 200:
-                tsprint("Error downloading map with ID " + id)
-                return
-        except:
-            tsprint("Error downloading map with ID " + id)
-            print(str(e))
-        
         # Unzip the response in memory
-        zip_file = zipfile.ZipFile(io.BytesIO(response.content)) 
-        count = 0
+        zip_file = zipfile.ZipFile(io.BytesIO(content))
+        names = zip_file.namelist()
 
-        for name in zip_file.namelist():
+        maps = []
+        for name in names:
             if name.endswith(".osu"):
-                zip_file.extract(name, extract_path_maps)
                 try:
-                    os.rename(extract_path_maps + name, extract_path_maps + id  + "_" + str(count) + ".osu")
-                    process_file(id + "_" + str(count) + ".osu")
-                except Exception as e:
-                    tsprint("Error renaming file with ID " + id)
-                    traceback.print_exc()
-                    os.remove(extract_path_maps + name)
-                    return
-
-                #crop the osu file to only have [HitObjects] section
-                with open(extract_path_maps + id + "_" + str(count) + ".osu", "r") as f:
-                    try:
-                        lines = f.readlines()
-                        if parse_difficulty(lines) == -1: continue
-                    except:
-                        tsprint("Error reading file with ID " + id)
-                        traceback.print_exc()
-                        os.remove(extract_path_maps + id + "_" + str(count) + ".osu")
-                        return
-                    writing = False
-                    with open(extract_path_maps + id + "_" + str(count) + ".osu", "w") as f2:
-                        for i, line in enumerate(lines):
-                            if line.startswith("[HitObjects]"): writing = True
-                            elif line.startswith("[Difficulty]"): writing = True
-                            elif line.startswith("[Editor]"): writing = False
-                            elif line.startswith("[Events]"): writing = False
-                            elif line.startswith("[TimingPoints]"): writing = True
-                            elif line.startswith("[Colours]"): writing = False
-                            elif line.startswith("[Metadata]"): writing = False
-
-                            if writing:
-                                f2.write(line)
-
-                count += 1
-            elif name.endswith(".mp3"):
-                zip_file.extract(name, extract_path_audio)
-                try:
-                    os.rename(extract_path_audio + name, extract_path_audio + id + ".mp3")
+                    parsed = parse_osu(zip_file.read(name).decode("utf-8-sig").splitlines(keepends=True))
                 except:
-                    tsprint("Error renaming file with ID " + id)
+                    tsprint("Error parsing " + name + " in map with ID " + id)
                     traceback.print_exc()
-                    os.remove(extract_path_audio + name)
-                    print(str(e))
+                    continue
+                if parsed is not None:
+                    maps.append(parsed)
+        if len(maps) == 0:
+            tsprint("No valid difficulties in map with ID " + id)
+            return BAD_ARCHIVE, [], {}
+
+        # Use the audio the difficulties reference (falling back to the first .mp3 in the archive)
+        audio_names = [audio_name for _, _, audio_name, _ in maps if audio_name in names and audio_name.endswith(".mp3")]
+        audio_names += [name for name in names if name.endswith(".mp3")]
+        if len(audio_names) == 0:
+            tsprint("No audio in map with ID " + id)
+            return NO_AUDIO, [], {}
+        # Store the audio under its content hash, unless another map already brought the same song
+        audio = zip_file.read(audio_names[0])
+        audio_sha1 = hashlib.sha1(audio).hexdigest()
+        audio_path = audio_filename(audio_sha1)
+        if not os.path.isfile(audio_path):
+            write_atomic(audio_path, io.BytesIO(audio))
+        artifacts = {audio_path: audio_sha1}
+
+        entries = []
+        for count, (cropped, difficulty, _, events) in enumerate(maps):
+            target_path = extract_path_pickles + id + "_" + str(count) + ".npz"
+            map_file = extract_path_maps + id + "_" + str(count) + ".osu"
+            save_events(target_path, *events)
+            artifacts[target_path] = file_sha1(target_path)
+            artifacts[map_file] = write_atomic(map_file, io.BytesIO("".join(cropped).encode("utf-8")))
+            entries.append(make_entry(id, count, audio_path,
+                                      extract_path_pickles + id + "_" + str(count) + ".npz",
+                                      difficulty, get_length(events[0]), audio_sha1))
+            if update_manifest:
+                get_manifest().add(entries[-1])
 
         tsprint("Downloaded map with ID " + id)
+        return OK, entries, artifacts
 
     except:
-        tsprint("Error downloading map with ID " + id)
-        return
-    
+        tsprint("Error extracting map with ID " + id)
+        traceback.print_exc()
+        return BAD_ARCHIVE, [], {}
+
 ##################
 # Main
 ##################
-def collect_data(num_maps=1000):
+def collect_data(num_maps=1000, downloader=None, pipeline=True):
     """
     Collects num_maps maps from the osu! API and processes them.
+    Downloads run continuously (see MapDownloader) until the catalog has num_maps extracted maps.
+    Only ids that have never been tried are downloaded; ids left pending by an interrupted run go first.
+    A new id is only drawn while the extracted maps plus the maps still being downloaded or parsed fall short of
+    num_maps, so the downloads and parses in flight do not overshoot it.
+    @param pipeline: Parse and featurize on process pools while downloading (see collector_pipeline.py).
+                     Otherwise archives are extracted on the download threads.
     """
-    while True:
-        if get_file_count(extract_path_maps) > num_maps:
-            break
-        with ThreadPoolExecutor() as executor:
-            # Submit downloadMap function for each map ID
+    c = get_catalog()
+    sampler = c.sample()
+    drawn = set() # ids drawn by this run
+    def random_ids():
+        while c.count(OK) < num_maps:
+            in_flight = len(drawn.intersection(c.ids(PENDING)))
+            if c.count(OK) + in_flight >= num_maps:
+                time.sleep(0.5) # wait for a map in flight to be recorded (it may fail)
+                continue
+            id = next(sampler)
+            drawn.add(int(id))
+            yield id
+
+    exporter = metrics.Exporter()
+    try:
+        if pipeline:
+            collector_pipeline.CollectorPipeline(downloader or get_downloader(), c, get_manifest(), extract_map,
+                                                 store_archive, record_map, tsprint).run(random_ids())
+        else:
+            (downloader or get_downloader()).run(random_ids(), handle_download)
+    finally:
+        exporter.stop()
 
-            # Generate 10000 random numbers from 500 to 1000000
-            random_numbers = [random.randint(1, 1000000) for _ in range(25)]
+    tsprint(f'Downloaded {num_maps} maps! Catalog: {c.summary()}')
 
-            futures = [executor.submit(downloadMap, str(i)) for i in random_numbers]
-            
-            # Wait for all tasks to complete
-            for future in futures:
-                future.result()
+def reprocess_archive(id, archive_sha1):
+    """
+    Extracts a map again from its stored archive (run in the worker processes of reprocess).
+    @return: What extract_map returns, or None if the archive is not in the store.
+    """
+    store = get_archive_store()
+    content = store.get(archive_sha1) if store is not None else None
+    if content is None:
+        return
+    return extract_map(id, content, update_manifest=False)
 
-    tsprint(f'Downloaded {num_maps} maps!')
+def reprocess(ids=None, workers=config.parse_workers):
+    """
+    Rebuilds the maps, pickles and audio of catalogued maps from the archive store, on a process pool and without
+    any downloads (e.g. after a change to parsing, the target format or cropping).
+    Every downloaded map is extracted again, including ones that failed to extract before. Files and manifest
+    entries the previous extraction produced but this one does not are removed. Maps whose archive is not in the
+    store (evicted, or downloaded before the store existed) are left as they are.
+    @param ids: The map ids to rebuild (defaults to every map with an archive).
+    @param workers: The number of processes extracting archives.
+    @return: A dict with the number of maps rebuilt, maps that did not extract, and archives not in the store.
+    """
+    if get_archive_store() is None:
+        tsprint("The archive store is disabled (config.archive_path is None); nothing to reprocess.")
+        return
+    c = get_catalog()
+    m = get_manifest()
+    archives = c.archives()
+    if ids is not None:
+        archives = {int(id): archives[int(id)] for id in ids if int(id) in archives}
+    keys = {} # map id -> manifest keys of its difficulties
+    for entry in m.live():
+        keys.setdefault(entry["map_id"], []).append(entry["key"])
+
+    counts = {"rebuilt": 0, "failed": 0, "missing": 0}
+    def rebuilt(item, result):
+        # Update the files, the manifest and the catalog here (on the stage's consumer thread), so only this
+        # process writes to them
+        id, archive_sha1 = item
+        if result is None:
+            tsprint("Archive of map with ID " + id + " is not in the store")
+            counts["missing"] += 1
+            return
+        status, entries, artifacts = result
+        for path in set(c.artifacts(id)) - set(artifacts):
+            # (audio that other maps share stays; maps collected before audio was deduplicated move to it here)
+            if c.owners(path).get(path, set()) <= {int(id)} and os.path.isfile(path):
+                os.remove(path)
+        new_keys = {entry["key"] for entry in entries}
+        for key in keys.get(id, []):
+            if key not in new_keys:
+                m.remove(key)
+        for entry in entries:
+            m.add(entry)
+        c.record(id, status, 200, archive_sha1, artifacts, len(entries))
+        metrics.counter("reprocess_maps_total", "Maps rebuilt from the archive store by outcome", status=status).inc()
+        counts["rebuilt" if status == OK else "failed"] += 1
+
+    def failed(item):
+        # The map is left as it was
+        counts["failed"] += 1
+
+    tsprint(f"Reprocessing {len(archives)} maps from {config.archive_path} with {workers} workers")
+    stage = collector_pipeline.Stage("reprocess", reprocess_archive, workers, config.pipeline_queue_size, rebuilt, failed)
+    try:
+        for id, archive_sha1 in archives.items():
+            stage.put((str(id), archive_sha1))
+    finally:
+        stage.close()
+    tsprint(f"Reprocessed maps: {counts}")
+    return counts
+
+def clean_data(remove=False):
+    """
+    Reconciles the data folders, the catalog and the manifest (see catalog.reconcile): removes orphan files,
+    maps with missing files and manifest entries of maps that are not ok.
+    Difficulties in the data folders that are not in the manifest yet (e.g. collected before it existed) are added
+    to it first, so reconcile adopts them instead of deleting them as orphans.
+    @param remove: Whether to delete anything (by default only the changes that would be made are counted).
+    """
+    if os.path.isdir(extract_path_pickles):
+        build_manifest(get_manifest())
+    result = reconcile(get_catalog(), get_manifest(), remove)
+    tsprint(f"Reconciled data folders: {result}" if remove else f"Would reconcile data folders (run clean with --remove to apply): {result}")
+    return result
 
 if __name__ == "__main__":
-    collect_data(500)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Collect osu! maps, or rebuild the data folders from the archive store")
+    parser.add_argument("command", nargs="?", choices=("collect", "reprocess", "clean"), default="collect")
+    parser.add_argument("--maps", type=int, default=500, help="The number of extracted maps to collect")
+    parser.add_argument("--ids", nargs="+", default=None, help="Only reprocess these map ids")
+    parser.add_argument("--workers", type=int, default=config.parse_workers, help="Processes extracting archives when reprocessing")
+    parser.add_argument("--remove", action="store_true", help="Make clean delete files (otherwise it only reports what it would delete)")
+    args = parser.parse_args()
+
+    if args.command == "collect":
+        collect_data(args.maps)
+    elif args.command == "reprocess":
+        reprocess(args.ids, args.workers)
+    else:
+        clean_data(args.remove)
\ No newline at end of file
@@ -0,0 +1,146 @@
+###########################
+# This file contains the map downloader used by the data collector.
+# Downloads share a pooled HTTP session, a bounded number of requests is kept in flight at all times
+# (a finished download immediately starts the next one), and failed requests are retried with
+# exponential backoff and jitter. An optional rate limit caps the number of requests per second.
+###########################
+
+
+# Python library imports
+import requests
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+# Our imports
+import config
+import metrics
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket that allows rate requests per second (with bursts of up to burst requests).
+    A rate of None (or 0) disables the limit.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be made.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class MapDownloader:
+    """
+    A class that downloads beatmap archives (.osz) from the osu! API.
+    """
+    def __init__(self, base_url=config.api_link, max_in_flight=config.download_concurrency,
+                 rate_limit=config.download_rate_limit, retries=config.download_retries,
+                 timeout=config.download_timeout, backoff=1.0):
+        """
+        @param base_url: The URL maps are downloaded from (the map id is appended to it).
+        @param max_in_flight: The number of downloads running at the same time.
+        @param rate_limit: The maximum number of requests per second (None for no limit).
+        @param retries: The number of times a failed request is retried.
+        @param timeout: The connect/read timeout of a request in seconds.
+        @param backoff: The base delay in seconds between retries (doubled after every attempt).
+        """
+        self.base_url = base_url
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate_limit, burst=max_in_flight)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, id):
+        """
+        Downloads the archive of a map.
+        Connection errors, timeouts, 429 and 5xx responses are retried; other responses are returned as is.
+        Retries wait a random time up to the exponential backoff (full jitter), or, if the server sent Retry-After,
+        at least that long plus a jitter of up to the base backoff.
+        @return: (status code, content). The status code is None if the request never got a response.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            retry_after = None
+            if attempt > 0:
+                metrics.counter("download_retries_total", "Download requests that were retries").inc()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(self.base_url + str(id), timeout=self.timeout)
+                metrics.histogram("download_seconds", "Time to download a map archive").observe(time.perf_counter() - start)
+                metrics.counter("download_responses_total", "Download responses by status code", code=response.status_code).inc()
+                metrics.counter("download_bytes_total", "Bytes of map archives downloaded").inc(len(response.content))
+                if response.status_code != 429 and response.status_code < 500:
+                    return response.status_code, response.content
+                header = response.headers.get("Retry-After")
+                if header is not None and header.isdigit():
+                    retry_after = int(header)
+                status = response.status_code
+            except requests.RequestException as e:
+                metrics.counter("download_errors_total", "Download requests without a response", error=type(e).__name__).inc()
+                status = None
+            if attempt < self.retries:
+                if retry_after is not None:
+                    time.sleep(retry_after + random.uniform(0, self.backoff))
+                else:
+                    time.sleep(random.uniform(0, self.backoff * 2 ** attempt)) # full jitter
+        return status, None
+
+    def run(self, ids, handle):
+        """
+        Downloads every map in ids, keeping max_in_flight downloads running until ids is exhausted.
+        ids may be a lazy iterator; it is only advanced when a download slot frees up.
+        @param ids: The map ids to download.
+        @param handle: Called as handle(id, status code, content) on a worker thread after each download.
+        """
+        ids = iter(ids)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = set()
+            for id in ids:
+                pending.add(executor.submit(self._download, id, handle))
+                if len(pending) >= self.max_in_flight:
+                    break
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for _ in done:
+                    id = next(ids, None)
+                    if id is not None:
+                        pending.add(executor.submit(self._download, id, handle))
+
+    def _download(self, id, handle):
+        try:
+            status, content = self.fetch(id)
+            handle(id, status, content)
+        except:
+            from model import tsprint # (imported here, so importing the downloader does not load librosa)
+            tsprint("Error downloading map with ID " + str(id))
+            traceback.print_exc()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,116 @@
+##########################
+# This file contains the on-disk cache for audio features (spectrograms).
+# Entries are keyed by the content hash of the audio file plus the parameters used to
+# compute the features, and are stored as .npy files so they can be memory-mapped on load.
+##########################
+
+
+# Python library imports
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+# Our imports
+import config
+
+
+class FeatureCache:
+    """
+    A class that represents a size-capped, content-addressed cache of feature arrays.
+    The least recently used entries are evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir=config.feature_cache_path, max_bytes=config.feature_cache_size):
+        """
+        Initializes the cache.
+        @param cache_dir: The directory the cached arrays are stored in.
+        @param max_bytes: The maximum total size of the cached arrays.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hashes = {} # (path, size, mtime) -> content hash, so unchanged files are only hashed once
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def content_hash(self, filename):
+        """
+        Returns the sha1 hash of a file's contents.
+        @param filename: The path to the file.
+        """
+        stat = os.stat(filename)
+        stamp = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if stamp in self.hashes:
+            return self.hashes[stamp]
+
+        sha = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        self.hashes[stamp] = sha.hexdigest()
+        return self.hashes[stamp]
+
+    def key(self, filename, sha1=None, **params):
+        """
+        Returns the cache key for a file and the parameters used to compute its features.
+        @param filename: The path to the audio file.
+        @param sha1: The content hash of the file if it is already known, e.g. from the manifest (skips hashing it).
+        @param params: The feature parameters (sample rate, number of bins, etc.)
+        """
+        param_str = ",".join(f"{name}={params[name]}" for name in sorted(params))
+        return (sha1 or self.content_hash(filename)) + "_" + hashlib.sha1(param_str.encode()).hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """
+        Returns the cached array for a key as a read-only memory map, or None if it is not cached.
+        """
+        path = self.path(key)
+        try:
+            arr = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass # (read-only storage, or the entry was just evicted; the mapped array is still readable)
+        return arr
+
+    def put(self, key, arr):
+        """
+        Stores an array in the cache and evicts old entries if the cache is over its size cap.
+        The array is written to a temporary file first so readers never see a partial entry.
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is under its size cap.
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".npy"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
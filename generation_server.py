@@ -0,0 +1,301 @@
+#################################
+# Description: This script runs a resident beatmap generation server.
+# The encoder/decoder weights are loaded once at startup; jobs (song + difficulty) are submitted over a local
+# HTTP API and run by a pool of worker threads. A worker that picks up a job also takes whatever else is queued
+# (up to max_batch jobs, waiting at most batch_wait seconds), and generates the whole micro-batch at once.
+# NOTE: This script should ONLY be run after the model has been trained.
+#
+# API (JSON):
+#   POST /jobs        {"song": ..., "difficulty": [6 floats], "output": ..., "wait": false} -> the job
+#                     (output is a path inside the server's output folder; anything outside it is rejected)
+#   GET  /jobs/<id>   -> the job (status queued/running/done/failed, latencies in seconds)
+#   GET  /metrics     -> the metrics in Prometheus text format
+#   GET  /health      -> {"ok": true, "queued": n}
+#################################
+
+# Python library imports
+import argparse
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import torch
+
+# Our imports
+import config
+import metrics
+from model import convert_to_spectrogram, tsprint
+from osu_beatmap_generator import get_device, load_models, generate_batch, tensor_to_map, estimate_timing
+
+
+class Job:
+    """
+    A generation request and its outcome.
+    """
+    ids = itertools.count(1)
+
+    def __init__(self, song, difficulty, output):
+        """
+        @param song: The song file (relative to the test audio folder, or an absolute path).
+        @param difficulty: The difficulty vector.
+        @param output: The path to save the beatmap.
+        """
+        self.id = next(Job.ids)
+        self.song = song
+        self.difficulty = [float(x) for x in difficulty]
+        self.output = output
+        self.status = "queued"
+        self.error = None
+        self.batch_size = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.finished = time.time()
+        self.status = "failed" if error is not None else "done"
+        self.error = error
+        metrics.counter("server_jobs_total", "Generation jobs by outcome", status=self.status).inc()
+        metrics.histogram("server_job_seconds", "Time from submitting a job until it finished").observe(self.finished - self.submitted)
+        self.done.set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "song": self.song,
+            "difficulty": self.difficulty,
+            "output": self.output,
+            "status": self.status,
+            "error": self.error,
+            "batch_size": self.batch_size,
+            "queue_seconds": (self.started - self.submitted) if self.started is not None else None,
+            "run_seconds": (self.finished - self.started) if self.finished is not None and self.started is not None else None,
+            "total_seconds": (self.finished - self.submitted) if self.finished is not None else None,
+        }
+
+
+def resolve_output(output_path, output):
+    """
+    Returns the absolute path of a job's beatmap.
+    @param output_path: The folder beatmaps are written to.
+    @param output: The path the client asked for, relative to output_path.
+    @raise ValueError: If the path is not inside output_path (e.g. an absolute path or one with ".." in it).
+    """
+    root = os.path.realpath(output_path)
+    path = os.path.realpath(os.path.join(root, output))
+    if path == root or os.path.commonpath((root, path)) != root:
+        raise ValueError(f"The output path {output} is not inside {output_path}")
+    return path
+
+
+class GenerationServer:
+    """
+    A class that keeps the model loaded and runs generation jobs from a queue.
+    """
+    def __init__(self, workers=config.server_workers, max_batch=config.server_max_batch,
+                 batch_wait=config.server_batch_wait, history=config.server_job_history, backend="float", recall=None,
+                 output_path=config.server_output_path):
+        """
+        @param workers: The number of worker threads running jobs.
+        @param max_batch: The maximum number of jobs generated together.
+        @param batch_wait: How long a worker waits for more jobs to batch with (seconds).
+        @param history: The number of finished jobs kept for GET /jobs/<id>.
+        @param backend: The inference backend (see osu_beatmap_generator.load_models).
+        @param recall: Decode only near onsets (see osu_beatmap_generator.decode), or None to decode every step.
+        @param output_path: The folder beatmaps are written to (see resolve_output).
+        """
+        self.device = get_device(backend)
+        models = load_models(self.device, backend)
+        if models is None:
+            raise FileNotFoundError("Model encoder/decoder does not exist. Please train the model first.")
+        self.encoder, self.decoder = models
+        self.recall = recall
+        self.output_path = output_path
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.history = history
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict() # id -> job
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name=f"generate-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, song, difficulty, output):
+        """
+        Queues a job. Returns the Job (wait on job.done to block until it has finished).
+        @param output: The path of the beatmap, relative to the output folder.
+        """
+        if len(difficulty) != 6:
+            raise ValueError("The difficulty vector needs 6 values (HP, CS, OD, AR, SV, TICK)")
+        job = Job(song, difficulty, resolve_output(self.output_path, output))
+        with self.lock:
+            self.jobs[job.id] = job
+            # Forget the oldest finished jobs
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                self.jobs.popitem(last=False)
+        self.queue.put(job)
+        metrics.gauge("server_queue_jobs", "Jobs waiting for a worker").set(self.queue.qsize())
+        return job
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def close(self):
+        """
+        Stops the workers after the queued jobs have finished.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _next_batch(self):
+        job = self.queue.get()
+        if job is None:
+            return None
+        batch = [job]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                job = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if job is None:
+                self.queue.put(None) # leave the stop signal for this worker's next round
+                break
+            batch.append(job)
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            metrics.gauge("server_queue_jobs", "Jobs waiting for a worker").set(self.queue.qsize())
+            metrics.histogram("server_batch_jobs", "Jobs per generated batch", buckets=(1, 2, 4, 8, 16, 32)).observe(len(batch))
+            try:
+                self._run(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for job in batch:
+                    if not job.done.is_set():
+                        job.finish(repr(e))
+
+    def _run(self, batch):
+        spectrograms = []
+        timings = []
+        ready = []
+        for job in batch:
+            job.started = time.time()
+            job.status = "running"
+            job.batch_size = len(batch)
+            with metrics.timer("generate_seconds", "Generation time by phase", phase="featurize"):
+                S = convert_to_spectrogram(os.path.join(config.test_audio_path, job.song))
+            if S is None:
+                job.finish(f"Could not convert {job.song} to a spectrogram.")
+                continue
+            spectrograms.append(torch.tensor(S.T).float().to(self.device))
+            timings.append(estimate_timing(S))
+            ready.append(job)
+        if len(ready) == 0:
+            return
+
+        beatmaps = generate_batch(self.encoder, self.decoder, spectrograms, [job.difficulty for job in ready], self.recall)
+        for job, beatmap, timing in zip(ready, beatmaps, timings):
+            try:
+                os.makedirs(os.path.dirname(job.output), exist_ok=True)
+                tensor_to_map(beatmap, job.difficulty, job.output, timing, os.path.basename(job.song))
+                job.finish()
+            except Exception as e:
+                traceback.print_exc()
+                job.finish(repr(e))
+            tsprint(f"Job {job.id} ({job.song}) {job.status} in {job.finished - job.submitted:.2f}s (batch of {len(batch)})")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP API of a GenerationServer (set as the generator attribute of the HTTP server).
+    """
+    def _reply(self, code, body, content_type="application/json"):
+        data = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        generator = self.server.generator
+        if self.path == "/health":
+            self._reply(200, {"ok": True, "queued": generator.queue.qsize()})
+        elif self.path == "/metrics":
+            self._reply(200, metrics.registry.prometheus_text(), "text/plain; version=0.0.4")
+        elif self.path.startswith("/jobs/") and self.path[len("/jobs/"):].isdigit():
+            job = generator.get(int(self.path[len("/jobs/"):]))
+            self._reply(200, job.to_dict()) if job is not None else self._reply(404, {"error": "unknown job"})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job = self.server.generator.submit(request["song"], request.get("difficulty", [5, 5, 5, 5, 5, 5]),
+                                               request.get("output", "output.osu"))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": repr(e)})
+            return
+        if request.get("wait"):
+            job.done.wait()
+            self._reply(200, job.to_dict())
+        else:
+            self._reply(202, job.to_dict())
+
+    def log_message(self, format, *args):
+        pass # jobs are logged by the workers
+
+
+def serve(host=config.server_host, port=config.server_port, **kwargs):
+    """
+    Starts a GenerationServer and serves its HTTP API until interrupted.
+    """
+    httpd = ThreadingHTTPServer((host, port), RequestHandler)
+    httpd.generator = GenerationServer(**kwargs)
+    tsprint(f"Serving on http://{host}:{port} ({len(httpd.generator.threads)} workers, batches of up to {httpd.generator.max_batch})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        httpd.generator.close()
+
+
+# Main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve beatmap generation over a local HTTP API")
+    parser.add_argument("--host", default=config.server_host)
+    parser.add_argument("--port", type=int, default=config.server_port)
+    parser.add_argument("--workers", type=int, default=config.server_workers, help="Worker threads running jobs")
+    parser.add_argument("--max-batch", type=int, default=config.server_max_batch, help="Maximum jobs generated together")
+    parser.add_argument("--batch-wait", type=float, default=config.server_batch_wait, help="Seconds to wait for jobs to batch with")
+    parser.add_argument("--backend", choices=("float", "script", "int8"), default="float", help="The inference backend (see inference.py)")
+    parser.add_argument("--recall", type=float, default=None, help="Only decode near onsets, keeping this fraction of them (see osu_beatmap_generator.py)")
+    parser.add_argument("--output-dir", default=config.server_output_path, help="Folder the beatmaps of jobs are written to")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, workers=args.workers, max_batch=args.max_batch, batch_wait=args.batch_wait,
+          backend=args.backend, recall=args.recall, output_path=args.output_dir)
@@ -0,0 +1,255 @@
+##########################
+# This file contains the CPU inference backends of the encoder/decoder.
+# "float" is the eager model (see model.py). "script" compiles the encoder and the whole autoregressive
+# decoder loop with TorchScript, using a fused step without dropout. "int8" also applies dynamic int8
+# quantization to the decoder's LSTM and Linear layers (CPU only). The encoder runs once per song, so it stays
+# float: quantizing it saves next to no time and visibly shifts the state the decoder starts from.
+# The compiled backends are wrapped so they can be used wherever the eager Encoder/Decoder are used for
+# generation (encoder(x, lengths, hc), decoder.start_input, decoder.generate, decoder.skip).
+##########################
+
+
+# Python library imports
+import argparse
+import io
+import os
+import time
+from typing import Optional, Tuple
+import torch
+
+# Our imports
+import config
+from model import num_features, convert_to_spectrogram, tsprint
+
+
+backends = ("float", "script", "int8")
+
+
+class EncoderCore(torch.nn.Module):
+    """
+    The encoder LSTM without dropout (scriptable).
+    """
+    def __init__(self, lstm):
+        super(EncoderCore, self).__init__()
+        self.lstm = lstm
+
+    def forward(self, x, hc: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        out, (h, c) = self.lstm(x, hc)
+        return out, h, c
+
+
+class DecoderLoop(torch.nn.Module):
+    """
+    The decoder's autoregressive loop with a fused step (LSTM -> hiddenfc -> outputfc, no dropout) (scriptable).
+    """
+    def __init__(self, lstm, hiddenfc, outputfc):
+        super(DecoderLoop, self).__init__()
+        self.lstm = lstm
+        self.hiddenfc = hiddenfc
+        self.outputfc = outputfc
+        self.num_features = num_features
+
+    @torch.jit.export
+    def step(self, x, h, c):
+        x, (h, c) = self.lstm(x, (h, c))
+        return self.outputfc(self.hiddenfc(x)), h, c
+
+    @torch.jit.export
+    def advance(self, inputs, h, c):
+        _, (h, c) = self.lstm(inputs, (h, c))
+        return h, c
+
+    def forward(self, decoder_input, h, c, difficulty, steps: int):
+        outputs = torch.zeros((difficulty.shape[0], steps, self.num_features))
+        context = difficulty.unsqueeze(1)
+        for i in range(steps):
+            out, h, c = self.step(decoder_input, h, c)
+            out = torch.round(out)
+            outputs[:, i:i + 1] = out
+            decoder_input = torch.cat((out, context), 2)
+        return outputs, h, c, decoder_input
+
+
+class InferenceEncoder:
+    """
+    Wraps a compiled EncoderCore so it is called like Encoder (padded batches are encoded song by song).
+    """
+    def __init__(self, core):
+        self.core = core
+
+    def __call__(self, x, lengths=None, hc=None):
+        if lengths is None:
+            out, h, c = self.core(x, hc)
+            return out, (h, c)
+        # Without packing, padding would leak into the backward direction, so encode each song on its own
+        outs, hs, cs = [], [], []
+        for i, n in enumerate(lengths.tolist()):
+            out, h, c = self.core(x[i:i + 1, :n], None if hc is None else (hc[0][:, i:i + 1], hc[1][:, i:i + 1]))
+            outs.append(out[0])
+            hs.append(h)
+            cs.append(c)
+        return torch.nn.utils.rnn.pad_sequence(outs, batch_first=True), (torch.cat(hs, 1), torch.cat(cs, 1))
+
+
+class InferenceDecoder:
+    """
+    Wraps a compiled DecoderLoop so it is called like Decoder.generate.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def start_input(self, difficulty):
+        return torch.cat((torch.zeros((difficulty.shape[0], 1, num_features)), difficulty.unsqueeze(1)), 2)
+
+    def generate(self, decoder_input, decoder_hidden, difficulty, steps):
+        outputs, h, c, decoder_input = self.loop(decoder_input, decoder_hidden[0].contiguous(), decoder_hidden[1].contiguous(), difficulty, steps)
+        return outputs, (h, c), decoder_input
+
+    def skip(self, decoder_input, decoder_hidden, difficulty, steps):
+        empty = self.start_input(difficulty)
+        inputs = torch.cat((decoder_input, empty.expand(-1, steps - 1, -1)), 1)
+        h, c = self.loop.advance(inputs, decoder_hidden[0].contiguous(), decoder_hidden[1].contiguous())
+        return (h, c), empty
+
+
+def compile_models(encoder, decoder, quantize=False):
+    """
+    Builds the scripted encoder core and decoder loop (optionally int8 quantized) from eager models.
+    """
+    encoder_core = EncoderCore(encoder.lstm).cpu().eval()
+    decoder_loop = DecoderLoop(decoder.lstm, decoder.hiddenfc, decoder.outputfc).cpu().eval()
+    if quantize:
+        decoder_loop = torch.ao.quantization.quantize_dynamic(decoder_loop, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+    return torch.jit.script(encoder_core), torch.jit.script(decoder_loop)
+
+
+def export_paths(backend, path=config.model_path):
+    return path + f"encoder_{backend}.pt", path + f"decoder_{backend}.pt"
+
+
+def export_backend(backend, path=config.model_path):
+    """
+    Compiles the trained weights in path and saves them as TorchScript files (encoder_<backend>.pt, decoder_<backend>.pt).
+    """
+    from osu_beatmap_generator import load_models
+    models = load_models(torch.device("cpu"))
+    if models is None:
+        return
+    encoder_file, decoder_file = export_paths(backend, path)
+    encoder_core, decoder_loop = compile_models(*models, quantize=backend == "int8")
+    torch.jit.save(encoder_core, encoder_file)
+    torch.jit.save(decoder_loop, decoder_file)
+    tsprint(f"Exported the {backend} backend to {encoder_file} and {decoder_file}")
+    return encoder_file, decoder_file
+
+
+def load_backend(backend, path=config.model_path):
+    """
+    Returns (encoder, decoder) for a compiled backend ("script" or "int8"), on the CPU.
+    Exported TorchScript files are used if they are newer than the trained weights; otherwise the backend is
+    compiled from the weights. Returns None if the model has not been trained yet.
+    """
+    encoder_file, decoder_file = export_paths(backend, path)
+    weights = [path + "encoder.pth", path + "decoder.pth"]
+    if os.path.isfile(encoder_file) and os.path.isfile(decoder_file) and \
+            all(not os.path.isfile(w) or os.path.getmtime(w) <= os.path.getmtime(encoder_file) for w in weights):
+        encoder_core, decoder_loop = torch.jit.load(encoder_file), torch.jit.load(decoder_file)
+    else:
+        from osu_beatmap_generator import load_models
+        models = load_models(torch.device("cpu"))
+        if models is None:
+            return
+        encoder_core, decoder_loop = compile_models(*models, quantize=backend == "int8")
+    return InferenceEncoder(encoder_core), InferenceDecoder(decoder_loop)
+
+
+def model_size(module):
+    """
+    Returns the size of a module's serialized weights in bytes.
+    """
+    buf = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        torch.jit.save(module, buf)
+    else:
+        torch.save(module.state_dict(), buf)
+    return buf.tell()
+
+
+def validate(backend, song_file=None, difficulty=(5, 5, 5, 5, 5, 5), steps=2000):
+    """
+    Compares a compiled backend against the float model and prints the drift and speed:
+    - step drift: both run one step on the same inputs (taken from the float model's own generation),
+    - generation agreement: both generate on their own from the same song,
+    - per-step latency and serialized model size.
+    @param song_file: A song in the test audio folder (None for random input).
+    @return: A dict with the results.
+    """
+    from osu_beatmap_generator import load_models
+    torch.manual_seed(0)
+    float_models = load_models(torch.device("cpu"))
+    if float_models is None:
+        return
+    encoder, decoder = float_models
+    encoder_core, decoder_loop = compile_models(encoder, decoder, quantize=backend == "int8")
+    fast_encoder, fast_decoder = InferenceEncoder(encoder_core), InferenceDecoder(decoder_loop)
+
+    if song_file is not None:
+        spectrogram = torch.tensor(convert_to_spectrogram(config.test_audio_path + song_file).T).float().unsqueeze(0)
+    else:
+        spectrogram = torch.randn(1, 2000, 84) * 20 - 40
+    difficulty = torch.tensor([difficulty]).float()
+
+    with torch.no_grad():
+        _, hc = encoder(spectrogram)
+        _, fast_hc = fast_encoder(spectrogram)
+        encoder_drift = max((a - b).abs().max().item() for a, b in zip(hc, fast_hc))
+
+        start = time.perf_counter()
+        float_out, _, _ = decoder.generate(decoder.start_input(difficulty), hc, difficulty, steps)
+        float_time = (time.perf_counter() - start) / steps
+        start = time.perf_counter()
+        fast_out, _, _ = fast_decoder.generate(fast_decoder.start_input(difficulty), fast_hc, difficulty, steps)
+        fast_time = (time.perf_counter() - start) / steps
+
+        # Teacher-force both on the float model's generated sequence and compare the raw outputs
+        inputs = torch.cat((torch.cat((torch.zeros_like(float_out[:, :1]), float_out[:, :-1]), 1),
+                            difficulty.unsqueeze(1).expand(-1, steps, -1)), 2)
+        raw, _ = decoder.lstm(inputs, hc)
+        raw = decoder.outputfc(decoder.hiddenfc(raw))
+        fast_raw = []
+        h, c = fast_hc
+        for i in range(steps):
+            out, h, c = decoder_loop.step(inputs[:, i:i + 1], h, c)
+            fast_raw.append(out)
+        step_drift = (raw - torch.cat(fast_raw, 1)).abs()
+
+    results = {
+        "backend": backend,
+        "encoder_state_max_abs_diff": encoder_drift,
+        "step_max_abs_diff": step_drift.max().item(),
+        "step_mean_abs_diff": step_drift.mean().item(),
+        "generated_rows_equal": (float_out == fast_out).all(2).float().mean().item(),
+        "generated_hits_equal": ((float_out[..., 2] != 0) == (fast_out[..., 2] != 0)).float().mean().item(),
+        "float_ms_per_step": float_time * 1000,
+        "backend_ms_per_step": fast_time * 1000,
+        "float_bytes": model_size(encoder) + model_size(decoder),
+        "backend_bytes": model_size(encoder_core) + model_size(decoder_loop),
+    }
+    for k, v in results.items():
+        print(f"{k:28s} {v}")
+    return results
+
+
+# Main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or validate a compiled inference backend")
+    parser.add_argument("command", choices=("export", "validate"))
+    parser.add_argument("--backend", choices=backends[1:], default="int8")
+    parser.add_argument("--song", default=None, help="A song in " + config.test_audio_path + " to validate on (default: random input)")
+    parser.add_argument("--steps", type=int, default=2000, help="Decoder steps to validate")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_backend(args.backend)
+    else:
+        validate(args.backend, args.song, steps=args.steps)
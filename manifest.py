@@ -0,0 +1,124 @@
+##########################
+# This file contains the dataset manifest.
+# The manifest is an append-only JSON lines file with one entry per difficulty (map id + difficulty index).
+# It records where the audio and target files are, the content hash of the audio (shared by every difficulty of
+# every mapset that uses the same song), the parsed [Difficulty] vector and the sequence length,
+# so the dataset never has to list directories or reopen .osu files.
+##########################
+
+
+# Python library imports
+import json
+import os
+import threading
+
+
+# Our imports
+import config
+
+
+def make_entry(map_id, diff_index, audio_path, pickle_path, difficulty, length, audio_sha1=None):
+    """
+    Creates a manifest entry.
+    @param map_id: The beatmap set id.
+    @param diff_index: The index of the difficulty within the set (the n in <id>_<n>.osu).
+    @param audio_path: The path to the audio file.
+    @param pickle_path: The path to the target file.
+    @param difficulty: The [Difficulty] vector (HP, CS, OD, AR, SliderMultiplier, SliderTickRate).
+    @param length: The number of target rows.
+    @param audio_sha1: The content hash of the audio file (its canonical id; None for maps collected before
+    audio was deduplicated).
+    """
+    return {
+        "key": str(map_id) + "_" + str(diff_index),
+        "map_id": str(map_id),
+        "diff_index": int(diff_index),
+        "audio_path": audio_path,
+        "pickle_path": pickle_path,
+        "difficulty": [float(x) for x in difficulty],
+        "length": int(length),
+        "audio_sha1": audio_sha1,
+    }
+
+
+class Manifest:
+    """
+    A class that represents the dataset manifest.
+    Entries keep the position they were first added at, so an index always refers to the same sample.
+    """
+    def __init__(self, path=config.manifest_path):
+        """
+        Loads the manifest at path (if it exists).
+        """
+        self.path = path
+        self.entries = []
+        self.index = {} # key -> position in self.entries
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.entries = []
+        self.index = {}
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                self._apply(json.loads(line))
+
+    def _apply(self, entry):
+        key = entry["key"]
+        if entry.get("removed"):
+            if key in self.index:
+                self.entries[self.index[key]] = None
+                del self.index[key]
+        elif key in self.index:
+            self.entries[self.index[key]] = entry
+        else:
+            self.index[key] = len(self.entries)
+            self.entries.append(entry)
+
+    def _append(self, entry):
+        with self.lock:
+            self._apply(entry)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def add(self, entry):
+        """
+        Adds (or replaces) an entry and appends it to the manifest file.
+        """
+        self._append(entry)
+
+    def remove(self, key):
+        """
+        Removes the entry with the given key.
+        """
+        if key in self.index:
+            self._append({"key": key, "removed": True})
+
+    def compact(self):
+        """
+        Rewrites the manifest file with only the live entries (drops replaced/removed lines).
+        """
+        with self.lock:
+            self.entries = [entry for entry in self.entries if entry is not None]
+            self.index = {entry["key"]: i for i, entry in enumerate(self.entries)}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def live(self):
+        """
+        Returns the live entries in the order they were added.
+        """
+        return [entry for entry in self.entries if entry is not None]
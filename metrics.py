@@ -0,0 +1,230 @@
+##########################
+# This file contains the metrics used to see where time goes in the collector, training and generation.
+# Counters, gauges and histograms live in one process-wide registry and are cheap enough to update on every
+# download, batch or generation step (one lock and a few additions). export() writes them as a Prometheus text
+# file (overwritten, for a node exporter textfile collector) and appends a JSON snapshot to a JSON lines log.
+# Metrics are per process: work done in pool processes is timed by the process that submitted it.
+##########################
+
+
+# Python library imports
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Our imports
+import config
+
+
+# Default histogram buckets (seconds)
+default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """
+    A value that only goes up.
+    """
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    """
+    A value that is set to the latest reading.
+    """
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Counts observations in cumulative buckets and keeps their sum (Prometheus style).
+    """
+    kind = "histogram"
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last bucket is +Inf
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the time spent in a with block (in seconds).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def sample(self):
+        with self.lock:
+            return {"count": self.count, "sum": self.sum,
+                    "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.cumulative()))}
+
+    def cumulative(self):
+        total = 0
+        out = []
+        for c in self.counts:
+            total += c
+            out.append(total)
+        return out
+
+
+class Registry:
+    """
+    A set of metrics, identified by name and labels.
+    """
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> metric
+        self.help = {} # name -> (kind, help text)
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels, **kwargs):
+        """
+        Returns the metric with the given name and labels, creating it on first use.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    if name in self.help and self.help[name][0] != cls.kind:
+                        raise ValueError(f"Metric {name} is a {self.help[name][0]}, not a {cls.kind}")
+                    self.help.setdefault(name, (cls.kind, help))
+                    metric = self.metrics[key] = cls(**kwargs)
+        return metric
+
+    def snapshot(self):
+        """
+        Returns every metric as a dict of name -> [{"labels": ..., "value": ...}].
+        """
+        with self.lock:
+            items = sorted(self.metrics.items())
+        out = {}
+        for (name, labels), metric in items:
+            out.setdefault(name, []).append({"labels": dict(labels), "value": metric.sample()})
+        return out
+
+    def prometheus_text(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            items = sorted(self.metrics.items())
+        lines = []
+        written = set()
+        for (name, labels), metric in items:
+            if name not in written:
+                kind, help = self.help[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                written.add(name)
+            if metric.kind == "histogram":
+                sample = metric.sample()
+                for bound, count in sample["buckets"].items():
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {sample['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {sample['count']}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {metric.sample()}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# The registry of this process
+registry = Registry()
+
+
+def counter(name, help="", **labels) -> Counter:
+    return registry.get(Counter, name, help, labels)
+
+
+def gauge(name, help="", **labels) -> Gauge:
+    return registry.get(Gauge, name, help, labels)
+
+
+def histogram(name, help="", buckets=default_buckets, **labels) -> Histogram:
+    return registry.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def timer(name, help="", **labels):
+    """
+    Times a with block into the histogram name (in seconds).
+    """
+    return histogram(name, help, **labels).time()
+
+
+def export(prometheus_path=config.metrics_prometheus_path, json_path=config.metrics_json_path):
+    """
+    Writes the metrics to a Prometheus text file (replaced atomically) and appends them to a JSON lines file.
+    Either path may be None to skip that format.
+    """
+    if prometheus_path is not None:
+        os.makedirs(os.path.dirname(prometheus_path) or ".", exist_ok=True)
+        tmp_path = prometheus_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(registry.prometheus_text())
+        os.replace(tmp_path, prometheus_path)
+    if json_path is not None:
+        os.makedirs(os.path.dirname(json_path) or ".", exist_ok=True)
+        with open(json_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": time.time(), "pid": os.getpid(), "metrics": registry.snapshot()}) + "\n")
+
+
+class Exporter:
+    """
+    Exports the metrics every interval seconds on a background thread (and once more when stopped).
+    """
+    def __init__(self, interval=config.metrics_interval):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            export()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        export()
@@ -7,68 +7,144 @@
 import librosa
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import pickle
 import torch
-from functools import reduce
-import gc
 import datetime
 import traceback
 
 
 # Our imports
 import config
+from feature_cache import FeatureCache
+from manifest import Manifest
+from corpus import Corpus, read_events
+from beatmap_events import load_events, densify, densify_frames, events_from_dense, num_columns, frame_columns
 
 # Get device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Spectrogram parameters
+sample_rate = 11025
+n_bins = 84
+bins_per_octave = 12
+hop_length = 512
+
+# The time grid of the targets: "ms" (one row per millisecond) or "frame" (one row per spectrogram frame, with
+# the offset of the object into the frame as an extra feature)
+target_grid = config.target_grid
+
+# Length of one spectrogram frame in ms
+frame_ms = hop_length * 1000 / sample_rate
+
 # num_features
-num_features = 8
+num_features = frame_columns if target_grid == "frame" else num_columns
+
+# Shared spectrogram cache (created on first use)
+feature_cache = None
 
 # Classes
 class Audio2Map(torch.utils.data.Dataset):
     """
     A class that represents the dataset of beatmaps.
+    Samples are looked up in the dataset manifest, so an index always refers to the same difficulty.
+    If a packed corpus exists (see corpus.py) and matches the current settings and manifest, samples are read from
+    its shards instead.
+    The dataset holds no state that changes while loading, so it can be used by DataLoader worker processes.
     """
-    def __init__(self, audio_dir, map_dir, pickle_dir):
+    def __init__(self, audio_dir, map_dir, pickle_dir, manifest_path=config.manifest_path, corpus_path=config.corpus_path):
         """
         Initializes the dataset.
+        If the manifest does not exist yet, it is built once by scanning the data directories from the config.
+        Difficulties whose audio or target file is missing, or that have no hit objects, are left out here,
+        so every index refers to a loadable sample.
+        @param corpus_path: The packed corpus to read from (None to always use the manifest).
         """
         self.audio_dir = audio_dir
         self.map_dir = map_dir
-        self.pickle_dir
+        self.pickle_dir = pickle_dir
+        self.corpus = None
+        if corpus_path is not None and os.path.isfile(os.path.join(corpus_path, "index.json")):
+            try:
+                corpus = Corpus(corpus_path)
+                problem = corpus.check(manifest_path)
+            except ValueError as e: # (a corpus with an older shard layout)
+                problem = str(e)
+            if problem is None:
+                self.corpus = corpus
+                self.entries = [entry for entry in self.corpus.entries if entry["length"] > 0]
+                return
+            tsprint(f"Not using the corpus in {corpus_path} (reading from the manifest instead): {problem}")
+        manifest = Manifest(manifest_path)
+        if len(manifest) == 0:
+            from data_collector import build_manifest
+            build_manifest(manifest)
+        self.entries = [entry for entry in manifest.live() if entry["length"] > 0 and
+                        os.path.isfile(entry["audio_path"]) and os.path.isfile(entry["pickle_path"])]
+        if len(self.entries) < len(manifest):
+            tsprint(f"Left out {len(manifest) - len(self.entries)} of {len(manifest)} difficulties with missing files or no hit objects.")
 
     def __len__(self):
-        return len([name for name in os.listdir(self.tar_dir) if os.path.isfile(os.path.join(self.tar_dir, name))])
+        return len(self.entries)
+
+    def get_lengths(self, indices=None):
+        """
+        Returns the target length of every sample (or of the samples at the given indices), e.g. for bucketing.
+        """
+        indices = range(len(self.entries)) if indices is None else indices
+        return [self.entries[i]["length"] for i in indices]
 
     def __getitem__(self, idx):
-        # use the listdir() index 5Head
-        # Get the current map name w/o .osu
-        files = [name for name in os.listdir(self.tar_dir) if os.path.isfile(os.path.join(self.tar_dir, name))]
-        idx -= self.deleted_counter
-        idx = min(idx, len(files) - 1)
-        print(f"files length: {len(files)}, index: {idx}")
-        currfile = files[idx][:-4]
-        spec = convert_to_spectrogram(os.path.join(self.in_dir, currfile.split('_', 1)[0] + ".mp3"))
-        while(type(spec) == type(None)):
-            idx += 1
-            currfile = files[idx][:-4]
-            spec = convert_to_spectrogram(os.path.join(self.in_dir, currfile.split('_', 1)[0] + ".mp3"))
-            if isinstance(spec, int):
-                print(f'Could not get item at index {idx} due to parsing spectrogram.') 
-                return -1
+        """
+        Returns (spectrogram frames, difficulty, target rows), or None if the files exist but cannot be decoded.
+        idx may also be (index, start ms, length ms) to get a window of the song (see window).
+        """
+        if isinstance(idx, tuple):
+            return self.window(*idx)
+        entry = self.entries[idx]
+        if self.corpus is not None:
+            input = torch.tensor(self.corpus.features(self.corpus.index[entry["key"]]))
+            diff = torch.tensor(entry["difficulty"]).float()
+            return input, diff, torch.from_numpy(make_target(self.corpus.events(self.corpus.index[entry["key"]])))
+        spec = convert_to_spectrogram(entry["audio_path"], sha1=entry.get("audio_sha1"))
+        if spec is None:
+            tsprint(f'Could not get item at index {idx} ({entry["key"]}) due to parsing spectrogram.')
+            return None
         input = torch.tensor(spec.T).float()
-        diff = parse_difficulty(os.path.join(self.maps_dir, currfile + ".osu"))
-        if isinstance(diff, int):
-            print(f'Could not get item at index {idx} due to parsing difficulty.') 
-            return -1
-        diff = torch.t(parse_difficulty(os.path.join(self.maps_dir, currfile + ".osu"))).float()
-        out = get_pkl(os.path.join(self.tar_dir, currfile + ".pkl"))[0].to_dense().float()
-        if isinstance(out, int):
-            print(f'Could not get item at index {idx} due to parsing pkl.') 
-            return -1
+        diff = torch.tensor(entry["difficulty"]).float()
+        out = get_target(entry["pickle_path"])
+        if out is None:
+            tsprint(f'Could not get item at index {idx} ({entry["key"]}) due to parsing targets.')
+            return None
         return input, diff, out
 
+    def window(self, idx, start, length):
+        """
+        Returns a window of a sample: the spectrogram frames and target rows from start to start + length ms.
+        The window is moved back to the nearest frame boundary, so row 0 lines up with frame 0. It is cut off at the
+        end of the song's targets.
+        """
+        entry = self.entries[idx]
+        first_frame = int(start * sample_rate / (hop_length * 1000))
+        start = int(round(frame_to_ms(first_frame)))
+        stop = min(start + length, entry["length"])
+        last_frame = -(-(stop * sample_rate) // (hop_length * 1000))
+        diff = torch.tensor(entry["difficulty"]).float()
+        if self.corpus is not None:
+            i = self.corpus.index[entry["key"]]
+            input = torch.tensor(self.corpus.features(i)[first_frame:last_frame])
+            return input, diff, torch.from_numpy(make_target(self.corpus.events(i), first_frame, stop))
+        spec = convert_to_spectrogram(entry["audio_path"], sha1=entry.get("audio_sha1"))
+        if spec is None:
+            tsprint(f'Could not get window of index {idx} ({entry["key"]}) due to parsing spectrogram.')
+            return None
+        try:
+            events = read_events(entry["pickle_path"])
+        except:
+            tsprint(f'Could not get window of index {idx} ({entry["key"]}) due to parsing targets.')
+            return None
+        input = torch.tensor(spec.T[first_frame:last_frame]).float()
+        return input, diff, torch.from_numpy(make_target(events, first_frame, stop))
+
 
 class Encoder(torch.nn.Module):
     """
@@ -82,8 +158,18 @@ class Encoder(torch.nn.Module):
         self.lstm = torch.nn.LSTM(self.audio_dim, self.hidden_dim, batch_first=True, bidirectional=True, device=device)
         self.dropout = torch.nn.Dropout(dropout)
         #Arbitrary numbers, may be changed later for parameter optimization
-    def forward(self, x):
-        out, hidden = self.lstm(x)
+    def forward(self, x, lengths=None, hc=None):
+        """
+        Runs the encoder over a spectrogram, or a padded batch of spectrograms with their lengths.
+        Padded batches are packed so the padding does not affect the final hidden state.
+        @param hc: An optional initial (h, c) state, e.g. to continue from a previous block of the song.
+        """
+        if lengths is None:
+            out, hidden = self.lstm(x, hc)
+        else:
+            packed = torch.nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            out, hidden = self.lstm(packed, hc)
+            out, _ = torch.nn.utils.rnn.pad_packed_sequence(out, batch_first=True, total_length=x.shape[1])
         out = self.dropout(out)
         return out, hidden
 
@@ -99,35 +185,108 @@ class Decoder(torch.nn.Module):
         self.hiddenfc = torch.nn.Linear(self.hidden_dim, self.hidden_dim//2, device=device)
         self.outputfc = torch.nn.Linear(self.hidden_dim//2, num_features, device=device)
 
-    def forward(self, encoder_out, encoder_hc, difficulty, target=None):
-        decoder_input = torch.zeros((1, num_features + 6), device=device)
+    def forward(self, encoder_out, encoder_hc, difficulty, target=None, step_by_step=False):
+        """
+        Runs the decoder. Inputs may be a single song (unbatched) or a padded batch (batch first).
+        With a target, the decoder is teacher-forced and returns the raw outputs (so the loss has gradients);
+        without one, it feeds back its rounded outputs for the length of the song.
+        Padded steps of a batch are decoded like real ones; masked_mse_loss leaves them out of the loss.
+        @param step_by_step: Teacher-force one step at a time instead of in a single LSTM call (for checking).
+        """
+        batched = difficulty.dim() == 2
+        if not batched:
+            encoder_out = encoder_out.unsqueeze(0)
+            encoder_hc = tuple(x.unsqueeze(1) for x in encoder_hc)
+            difficulty = difficulty.unsqueeze(0)
+            target = target.unsqueeze(0) if target is not None else None
+
+        if target is not None and not step_by_step:
+            decoder_outputs, decoder_hidden = self.forward_teacher(encoder_hc, difficulty, target)
+        else:
+            decoder_outputs, decoder_hidden = self.forward_loop(encoder_out, encoder_hc, difficulty, target)
+
+        if not batched:
+            decoder_outputs = decoder_outputs.squeeze(0)
+            decoder_hidden = tuple(x.squeeze(1) for x in decoder_hidden)
+        return decoder_outputs, decoder_hidden, None
+
+    def start_input(self, difficulty):
+        """
+        Returns the first decoder input of each song: an empty row followed by the difficulty.
+        """
+        return torch.cat((torch.zeros((difficulty.shape[0], 1, num_features), device=difficulty.device), difficulty.unsqueeze(1)), 2)
+
+    def forward_teacher(self, encoder_hc, difficulty, target):
+        """
+        Teacher-forced decoding in a single pass: the inputs are the targets shifted right by one row
+        (starting from an empty row), with the difficulty appended to every step.
+        Padded batches are not packed: the LSTM only runs forward, so padding at the end of a song cannot change
+        the outputs of its real rows (and the loss masks the rest). Packing made the backward pass orders of
+        magnitude slower on CPU. For padded songs, the returned hidden state is the one after the padding.
+        """
+        shifted = torch.cat((torch.zeros_like(target[:, :1]), target[:, :-1]), 1)
+        decoder_input = torch.cat((shifted, difficulty.unsqueeze(1).expand(-1, target.shape[1], -1)), 2)
+        x, hc = self.lstm(decoder_input, encoder_hc)
+        drp = self.dropout(x)
+        hidden = self.hiddenfc(drp)
+        out = self.outputfc(hidden)
+        return out, hc
+
+    def forward_loop(self, encoder_out, encoder_hc, difficulty, target=None):
+        """
+        Step-by-step decoding. Teacher-forced with a target, otherwise autoregressive on the rounded outputs.
+        """
+        if target is None:
+            #currStop = torch.cat((STOP.to(device), difficulty.unsqueeze(0)), 1)
+            #while(not torch.equal(decoder_input, currStop)):
+            iter = librosa.get_duration(S=encoder_out[0].T, sr=11025)*100
+            # (num samples/sr)*1000 = time in ms
+            if target_grid == "frame":
+                iter = encoder_out.shape[1] # one step per frame
+            decoder_outputs, decoder_hidden, _ = self.generate(self.start_input(difficulty), encoder_hc, difficulty, int(iter))
+            return decoder_outputs, decoder_hidden
+
+        decoder_input = self.start_input(difficulty)
         decoder_hidden = encoder_hc
         decoder_outputs = []
+        for i in range(target.shape[1]):
+            decoder_output, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
+            decoder_outputs.append(decoder_output)
+            decoder_input = torch.cat((target[:, i], difficulty), 1).unsqueeze(1)
 
-        prev_percent = 0
-        #currStop = torch.cat((STOP.to(device), difficulty.unsqueeze(0)), 1)
+        return torch.cat(decoder_outputs, 1), decoder_hidden
 
-        #while(not torch.equal(decoder_input, currStop)):
-        iter = target.shape[0] if target != None else librosa.get_duration(S=encoder_out.T, sr=11025)*100
-        # (num samples/sr)*1000 = time in ms
-        for i in range(int(iter)):
+    def generate(self, decoder_input, decoder_hidden, difficulty, steps):
+        """
+        Runs the decoder autoregressively for a number of steps, feeding back its rounded outputs.
+        Returns the outputs, the hidden state and the next input, so generation can be resumed later.
+        @param decoder_input: The first input (batch, 1, features + 6), e.g. start_input(difficulty).
+        @param decoder_hidden: The initial (h, c) state.
+        @param difficulty: The difficulty vectors (batch, 6).
+        @param steps: The number of steps to run.
+        """
+        decoder_outputs = []
+        for i in range(steps):
             decoder_output, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
-            decoder_output = torch.round(decoder_output)
-            decoder_outputs.append(decoder_output.detach())
-
-            if target is not None:
-                curr_percent = floor(((i+1)/target.shape[0])*100)
-                if curr_percent > prev_percent:
-                    prev_percent = curr_percent
-                    #print(f"Training...{curr_percent}%")
-                decoder_input = torch.cat((target[i], difficulty), 0).unsqueeze(0)
-            else:
-                if (i+1) % 1000 == 0:
-                    print(decoder_output)
-                decoder_input = torch.cat((decoder_output, difficulty.unsqueeze(0)), 1).detach()
-
-        decoder_outputs = torch.cat(decoder_outputs, 0)
-        return decoder_outputs, decoder_hidden, None
+            decoder_output = torch.round(decoder_output).detach()
+            decoder_outputs.append(decoder_output)
+            decoder_input = torch.cat((decoder_output, difficulty.unsqueeze(1)), 2)
+
+        if len(decoder_outputs) == 0:
+            return torch.zeros((difficulty.shape[0], 0, num_features), device=difficulty.device), decoder_hidden, decoder_input
+        return torch.cat(decoder_outputs, 1), decoder_hidden, decoder_input
+
+    def skip(self, decoder_input, decoder_hidden, difficulty, steps):
+        """
+        Advances the hidden state over steps on which the decoder is assumed to output nothing (see
+        osu_beatmap_generator.generate_sparse). The inputs are known in advance (empty rows after the first), so
+        this is a single LSTM call without the output layers.
+        Returns the hidden state and the next input.
+        """
+        empty = self.start_input(difficulty)
+        inputs = torch.cat((decoder_input, empty.expand(-1, steps - 1, -1)), 1)
+        _, decoder_hidden = self.lstm(inputs, decoder_hidden)
+        return decoder_hidden, empty
 
     def forward_step(self, x, hc):
         x, hc = self.lstm(x, hc)
@@ -136,6 +295,141 @@ class Decoder(torch.nn.Module):
         out = self.outputfc(hidden)
         return out, hc
 
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """
+    A batch sampler whose batch order for the current epoch can be saved and restored, so training can resume
+    in the middle of an epoch with the same batches (see checkpoint.py). Subclasses make the order in make_batches.
+    """
+    order = None # the batches of the current epoch
+    resume_at = 0 # the number of batches of the order to skip (when it was restored mid-epoch)
+    consumed = True # whether an iterator ran through the order, so the next iteration starts a new epoch
+
+    def make_batches(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        # A DataLoader with workers may call iter() more than once per epoch, so the order (and the skip of a
+        # restored one) is kept until an iterator has run through it
+        if self.consumed:
+            self.order = self.make_batches()
+            self.resume_at = 0
+            self.consumed = False
+        return self._iterate(self.order[self.resume_at:])
+
+    def _iterate(self, batches):
+        yield from batches
+        self.consumed = True
+        self.resume_at = 0
+
+    def state_dict(self):
+        return {"order": self.order}
+
+    def load_state_dict(self, state, batch):
+        """
+        Restores the batch order of an epoch; the next iteration starts after the first batch batches.
+        """
+        self.order = state["order"]
+        self.consumed = self.order is None or batch >= len(self.order)
+        self.resume_at = 0 if self.consumed else batch
+
+class BucketBatchSampler(ResumableBatchSampler):
+    """
+    A batch sampler that groups samples of similar length, so padded batches waste little computation.
+    Indices are shuffled, split into buckets of batch_size * bucket_factor samples, sorted by length within
+    each bucket and cut into batches; the batches are then shuffled.
+    """
+    def __init__(self, lengths, batch_size, bucket_factor=50, shuffle=True):
+        """
+        @param lengths: The sequence length of every sample in the dataset.
+        @param batch_size: The number of samples per batch.
+        @param bucket_factor: The number of batches per bucket.
+        @param shuffle: Whether to shuffle the samples and batches every epoch.
+        """
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_factor
+        self.shuffle = shuffle
+
+    def make_batches(self):
+        indices = torch.randperm(len(self.lengths)).tolist() if self.shuffle else list(range(len(self.lengths)))
+        batches = []
+        for b in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[b:b + self.bucket_size], key=lambda i: self.lengths[i])
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+class WindowBatchSampler(ResumableBatchSampler):
+    """
+    A batch sampler that yields fixed-length windows of songs instead of whole songs, so every step has about
+    the same cost however long the songs are.
+    Window starts lie on a grid of stride ms over each song; every epoch, crops_per_song of them are drawn at
+    random for each song (songs shorter than one window give a single window of the whole song).
+    Batches are lists of (index, start ms, length ms), which Audio2Map turns into windows.
+    """
+    def __init__(self, indices, lengths, batch_size, window=config.window_length, stride=config.window_stride,
+                 crops_per_song=config.window_crops, shuffle=True):
+        """
+        @param indices: The dataset indices of the songs to sample from.
+        @param lengths: The target length of each of those songs in ms.
+        @param batch_size: The number of windows per batch.
+        @param window: The window length in ms.
+        @param stride: The spacing of window starts in ms.
+        @param crops_per_song: The number of windows drawn per song every epoch.
+        @param shuffle: Whether to draw windows at random (otherwise the first crops_per_song starts are used).
+        """
+        self.indices = list(indices)
+        self.starts = [max(0, (length - window) // stride) + 1 for length in lengths] # window starts per song
+        self.batch_size = batch_size
+        self.window = window
+        self.stride = stride
+        self.crops_per_song = crops_per_song
+        self.shuffle = shuffle
+
+    def make_batches(self):
+        crops = []
+        for idx, starts in zip(self.indices, self.starts):
+            n = min(self.crops_per_song, starts)
+            chosen = torch.randperm(starts)[:n].tolist() if self.shuffle else range(n)
+            crops += [(idx, s * self.stride, self.window) for s in chosen]
+        if self.shuffle:
+            crops = [crops[i] for i in torch.randperm(len(crops)).tolist()]
+        return [crops[i:i + self.batch_size] for i in range(0, len(crops), self.batch_size)]
+
+    def __len__(self):
+        return (sum(min(self.crops_per_song, starts) for starts in self.starts) + self.batch_size - 1) // self.batch_size
+
+def collate_maps(batch):
+    """
+    Pads a list of (input, difficulty, target) samples into a batch.
+    Samples that could not be loaded (None) are dropped; returns None if none are left.
+    @return: (inputs, difficulties, targets, input_lengths, target_lengths)
+    """
+    batch = [sample for sample in batch if sample is not None]
+    if len(batch) == 0:
+        return None
+    inputs, diffs, targets = zip(*batch)
+    input_lengths = torch.tensor([x.shape[0] for x in inputs])
+    target_lengths = torch.tensor([y.shape[0] for y in targets])
+    inputs = torch.nn.utils.rnn.pad_sequence(inputs, batch_first=True)
+    targets = torch.nn.utils.rnn.pad_sequence(targets, batch_first=True)
+    return inputs, torch.stack(diffs), targets, input_lengths, target_lengths
+
+def masked_mse_loss(output, target, lengths):
+    """
+    Mean squared error over the unpadded rows of a batch.
+    @param output: The decoder output (batch, rows, features).
+    @param target: The padded targets (batch, rows, features).
+    @param lengths: The number of real rows in each sample.
+    """
+    mask = (torch.arange(target.shape[1], device=target.device)[None, :] < lengths.to(target.device)[:, None]).unsqueeze(2)
+    sq_err = (output - target) ** 2 * mask
+    return sq_err.sum() / (mask.sum() * target.shape[2]).clamp(min=1)
+
 def tsprint(s):
     """
     Prints a string with a timestamp in front of it.
@@ -144,25 +438,127 @@ def tsprint(s):
 
 
 
-def convert_to_spectrogram(filename):
+def get_pkl(filename):
+    """
+    Loads a pickled target file. Returns None if it cannot be loaded.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except:
+        tsprint("ERROR: cannot load .pkl file " + filename + ".")
+
+def make_target(events, start_frame=0, stop=None):
+    """
+    Returns the target rows of an event table on the target grid, from a spectrogram frame up to stop ms.
+    @param start_frame: The frame the rows start at.
+    @param stop: The end of the rows in ms (defaults to the last hit).
+    """
+    if target_grid == "frame":
+        return densify_frames(events, frame_ms, start_frame, None if stop is None else int(np.ceil(stop / frame_ms)))
+    return densify(events, int(round(frame_to_ms(start_frame))), stop)
+
+def get_target(filename):
+    """
+    Loads the target rows for a difficulty from an .npz event table (or an old .pkl file).
+    Returns None if they cannot be loaded.
+    """
+    if not filename.endswith(".npz"):
+        out = get_pkl(filename)
+        if out is None:
+            return None
+        dense = out[0].to_dense().float()
+        return dense if target_grid == "ms" else torch.from_numpy(make_target(events_from_dense(dense.numpy())))
     try:
-        targetSampleRate = 11025
-        y, sr = librosa.load(filename, sr=targetSampleRate)
-        C = np.abs(librosa.cqt(y, sr=targetSampleRate, n_bins=84, bins_per_octave=12))
+        events, _, _ = load_events(filename)
+        return torch.from_numpy(make_target(events))
+    except:
+        tsprint("ERROR: cannot load targets from " + filename + ".")
+
+def get_feature_cache():
+    """
+    Returns the shared spectrogram cache, or None if caching is disabled in the config.
+    """
+    global feature_cache
+    if feature_cache is None and config.feature_cache_path is not None:
+        feature_cache = FeatureCache(config.feature_cache_path, config.feature_cache_size)
+    return feature_cache
+
+def frame_to_ms(frame):
+    """
+    Returns the start time of a spectrogram frame in ms.
+    """
+    return frame * hop_length * 1000 / sample_rate
+
+def convert_to_spectrogram(filename, use_cache=True, sha1=None):
+    """
+    Converts an audio file to a constant-Q spectrogram (in dB).
+    Spectrograms are cached on disk by the content of the audio, so repeated calls for the same song (from any
+    difficulty of any mapset) only cost a read.
+    @param filename: The path to the audio file.
+    @param use_cache: Whether to read from/write to the spectrogram cache.
+    @param sha1: The content hash of the audio if it is known (see manifest.make_entry), so it is not hashed again.
+    """
+    try:
+        cache = get_feature_cache() if use_cache else None
+        if cache is not None:
+            key = cache.key(filename, sha1, sr=sample_rate, n_bins=n_bins, bins_per_octave=bins_per_octave, hop_length=hop_length)
+            S = cache.get(key)
+            if S is not None:
+                return S
+
+        y, sr = librosa.load(filename, sr=sample_rate)
+        C = np.abs(librosa.cqt(y, sr=sample_rate, hop_length=hop_length, n_bins=n_bins, bins_per_octave=bins_per_octave))
         S = librosa.amplitude_to_db(C, ref=np.max)
         #plot the spectrogram
 
-        '''plt.figure(figsize=(12, 4))
-        librosa.display.specshow(S, sr=targetSampleRate, x_axis='time', y_axis='cqt_note')
+        '''import matplotlib.pyplot as plt
+        plt.figure(figsize=(12, 4))
+        librosa.display.specshow(S, sr=sample_rate, x_axis='time', y_axis='cqt_note')
         plt.colorbar(format='%+2.0f dB')
         plt.title('Constant-Q power spectrogram')
         plt.tight_layout()
         plt.show()'''
+        if cache is not None:
+            cache.put(key, S)
         return S
     except:
         tsprint("ERROR: cannot convert " + filename + " to spectrogram.")
         traceback.print_exc()
 
+def stream_spectrogram(filename, block_frames=2048, context_frames=16, use_cache=True):
+    """
+    Yields the spectrogram of an audio file in blocks of up to block_frames frames (n_bins x frames),
+    so long songs never have to be featurized (or held in memory) all at once.
+    Cached spectrograms are read straight from the cache. Otherwise each block is computed from a slice of
+    the audio with context_frames of extra audio on each side, and converted to dB relative to the loudest
+    value seen so far (the full spectrogram uses the loudest value in the whole song).
+    @param filename: The path to the audio file.
+    @param block_frames: The number of frames per block.
+    @param context_frames: The number of frames of extra audio loaded on each side of a block.
+    """
+    cache = get_feature_cache() if use_cache else None
+    if cache is not None:
+        S = cache.get(cache.key(filename, sr=sample_rate, n_bins=n_bins, bins_per_octave=bins_per_octave, hop_length=hop_length))
+        if S is not None:
+            for f0 in range(0, S.shape[1], block_frames):
+                yield np.array(S[:, f0:f0 + block_frames])
+            return
+
+    total_frames = int(librosa.get_duration(path=filename) * sample_rate) // hop_length + 1
+    ref = 0
+    for f0 in range(0, total_frames, block_frames):
+        f1 = min(f0 + block_frames, total_frames)
+        before = min(context_frames, f0)
+        # (a quarter-sample nudge keeps the offset from being truncated to the previous sample)
+        y, sr = librosa.load(filename, sr=sample_rate,
+                             offset=((f0 - before) * hop_length + 0.25) / sample_rate,
+                             duration=(f1 - f0 + before + context_frames) * hop_length / sample_rate)
+        C = np.abs(librosa.cqt(y, sr=sample_rate, hop_length=hop_length, n_bins=n_bins, bins_per_octave=bins_per_octave))
+        C = C[:, before:before + f1 - f0]
+        ref = max(ref, C.max(initial=0))
+        yield librosa.amplitude_to_db(C, ref=ref)
+
 def print_details():
     """
     Print the details and stats of the model that is about to be trained.
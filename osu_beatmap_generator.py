@@ -6,90 +6,364 @@
 
 # Python library imports
 import torch
+import librosa
 import numpy as np
 import os
+import argparse
 
 # Our imports
 import config
-from model import convert_to_spectrogram
+import metrics
+from model import convert_to_spectrogram, stream_spectrogram, sample_rate, hop_length, target_grid, frame_ms, num_features, frame_to_ms
 from model import Encoder, Decoder
+from beatmap_events import events_from_dense, events_from_frames
+from osu_writer import write_beatmap, format_header, format_timing_points, format_hitobjects, default_timing
 
 # Configuration
 model_path = config.model_path
 audio_path = config.test_audio_path
 
+# The decoder emits one row every step_ms milliseconds when generating on the "ms" target grid
+# (on the "frame" grid it emits one row per spectrogram frame)
+step_ms = 10
+
 ####################################
 # Helper Functions
 ####################################
 
 
-def tensor_to_map(beatmap, output_path):
+def decoder_events(beatmap, start_step=0):
     """
-    Converts a tensor to a beatmap.
-    @param beatmap: The beatmap tensor.
-    @return: The beatmap.
+    Converts decoder output rows into an event table with exact ms times.
+    On the "frame" grid an object's time is the start of its frame plus its predicted offset.
     """
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write("[Difficulty]\n")
-        f.write(f'HPDrainRate:{difficulties[0]}\n')
-        f.write(f'CircleSize:{difficulties[1]}\n')
-        f.write(f'OverallDifficulty:{difficulties[2]}\n')
-        f.write(f'ApproachRate:{difficulties[3]}\n')
-        f.write(f'SliderMultiplier:{difficulties[4]}\n')
-        f.write(f'SliderTickRate:{difficulties[5]}\n')
-        f.write("\n")
-        f.write("[HitObjects]\n")
-        for i in range(beatmap.shape[0]):
-            for j in range(beatmap.shape[1]):
-                if not beatmap[i, j] == 0: print(beatmap[i])
-        #Write the timing points
+    beatmap = beatmap.detach().cpu().numpy()
+    if target_grid == "frame":
+        return events_from_frames(beatmap, frame_ms, start_step)
+    return events_from_dense(beatmap, start_step * step_ms, step_ms)
+
 
+def estimate_timing(S):
+    """
+    Returns a timing point with the estimated tempo of a song, starting at its first onset.
+    @param S: The spectrogram (n_bins x frames, in dB).
+    """
+    envelope = librosa.onset.onset_strength(S=S, sr=sample_rate, hop_length=hop_length)
+    tempo = librosa.feature.tempo(onset_envelope=envelope, sr=sample_rate, hop_length=hop_length)[0]
+    onsets = librosa.onset.onset_detect(onset_envelope=envelope, sr=sample_rate, hop_length=hop_length)
+    timing = default_timing.copy()
+    if tempo > 0:
+        timing["beat_length"] = 60000 / tempo
+    if len(onsets) > 0:
+        timing["time"] = round(frame_to_ms(onsets[0]))
+    return timing
 
 
-def generate_beatmap(song_file, difficulties, output_path):
+def tensor_to_map(beatmap, difficulties, output_path, timing=default_timing, audio_filename=""):
     """
-    Generates a beatmap for a given song.
-    @param song_path: The song file name. (PATH NOT INCLUDED)
+    Converts a tensor to a beatmap.
+    @param beatmap: The decoder output (rows x features) on the target grid.
+    @param difficulties: The difficulty vector the beatmap was generated with.
     @param output_path: The path to save the beatmap.
+    @param timing: The timing points (see estimate_timing).
+    @param audio_filename: The song file name written to the [General] section.
     """
-    # Get the device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    write_beatmap(output_path, decoder_events(beatmap), difficulties, timing, audio_filename=audio_filename)
 
-    # Convert song to spectrogram
-    spectrogram = convert_to_spectrogram(config.test_audio_path + song_file)
-    if isinstance(spectrogram, int):
-        print(f"ERROR: Could not convert {song_file} to a spectrogram.")
-        return
-    spectrogram = torch.tensor(spectrogram.T).float().to(device)
 
-    # Format difficulties
-    difficulties = torch.tensor(difficulties).float().to(device)
+def get_device(backend="float"):
+    """
+    Returns the device generation runs on (the compiled backends are CPU only).
+    """
+    return torch.device("cuda" if torch.cuda.is_available() and backend == "float" else "cpu")
 
-    # Create the encoder and decoder
-    encoder = Encoder(0.4).to(device)
-    decoder = Decoder(0.4).to(device)
 
-    # Load the model if it exists
+def load_models(device, backend="float"):
+    """
+    Creates the encoder and decoder and loads the trained weights.
+    Returns (encoder, decoder), or None if the model has not been trained yet.
+    @param backend: "float" for the eager model, or a compiled CPU backend ("script", "int8", see inference.py).
+    """
+    if backend != "float":
+        from inference import load_backend
+        return load_backend(backend)
     if not os.path.isfile(model_path + "encoder.pth") or not os.path.isfile(model_path + "decoder.pth"):
         print("ERROR: Model encoder/decoder does not exist. Please train the model first.")
         return
     encoder = Encoder(0.4).to(device)
     decoder = Decoder(0.4).to(device)
-    encoder.load_state_dict(torch.load(model_path + "encoder.pth"))
-    decoder.load_state_dict(torch.load(model_path + "decoder.pth"))
+    encoder.load_state_dict(torch.load(model_path + "encoder.pth", map_location=device))
+    decoder.load_state_dict(torch.load(model_path + "decoder.pth", map_location=device))
+    encoder.eval()
+    decoder.eval()
+    return encoder, decoder
 
-    # Process the spectrogram
-    rhythm, rhythm_hc= encoder(spectrogram)
-    beatmap, _, _ = decoder(rhythm, rhythm_hc, difficulties)
 
-    # Convert the beatmap to a file
-    tensor_to_map(beatmap, output_path)
+def song_steps(frames):
+    """
+    Returns the number of decoder steps (rows on the target grid) for a spectrogram with the given number of frames.
+    """
+    if target_grid == "frame":
+        return frames
+    return int(frames * hop_length / sample_rate * 1000 / step_ms)
 
 
-# Main
-if __name__ == "__main__":
-    difficulties = [5, 5, 5, 5, 5, 5]
-    generate_beatmap("7484.mp3", difficulties, "output.osu")
+####################################
+# Sparse decoding
+####################################
+
+
+def onset_candidates(S, recall, margin=config.onset_margin):
+    """
+    Returns the spectrogram frames that may hold a hit object: the peaks of the onset strength of the song.
+    @param S: The spectrogram (n_bins x frames, in dB).
+    @param recall: The fraction of onset peaks to keep, strongest first (1 keeps every peak; lower values are
+    faster but skip quieter onsets).
+    @param margin: The number of frames around each kept peak that are candidates too.
+    @return: A boolean mask over the frames.
+    """
+    envelope = librosa.onset.onset_strength(S=S, sr=sample_rate, hop_length=hop_length)
+    peaks = librosa.onset.onset_detect(onset_envelope=envelope, sr=sample_rate, hop_length=hop_length)
+    keep = peaks[np.argsort(envelope[peaks])[::-1][:int(np.ceil(recall * len(peaks)))]]
+    mask = np.zeros(S.shape[1], dtype=bool)
+    for shift in range(-margin, margin + 1):
+        mask[np.clip(keep + shift, 0, len(mask) - 1)] = True
+    return mask
+
+
+def candidate_steps(frames, steps):
+    """
+    Converts a mask over spectrogram frames into a mask over the first steps decoder steps (every step that
+    overlaps a candidate frame).
+    """
+    if target_grid == "frame":
+        mask = np.zeros(steps, dtype=bool)
+        mask[:min(steps, len(frames))] = frames[:steps]
+        return mask
+    candidates = np.flatnonzero(frames)
+    starts = np.clip(np.floor(candidates * frame_ms / step_ms).astype(np.int64), 0, steps)
+    stops = np.clip(np.ceil((candidates + 1) * frame_ms / step_ms).astype(np.int64), 0, steps)
+    delta = np.zeros(steps + 1, dtype=np.int64)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, stops, -1)
+    return np.cumsum(delta[:-1]) > 0
+
+
+def generate_sparse(decoder, decoder_input, decoder_hidden, difficulty, mask):
+    """
+    Runs the decoder autoregressively only on the steps in mask. The rows in between are left empty, and the
+    hidden state is advanced over them with decoder.skip (one LSTM call per gap instead of a step per row).
+    @param mask: A boolean mask over the steps (its length is the number of steps).
+    @return: The outputs (batch, steps, features).
+    """
+    outputs = torch.zeros((difficulty.shape[0], len(mask), num_features), device=difficulty.device)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    position = 0
+    for start, stop in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        if start > position:
+            decoder_hidden, decoder_input = decoder.skip(decoder_input, decoder_hidden, difficulty, start - position)
+        out, decoder_hidden, decoder_input = decoder.generate(decoder_input, decoder_hidden, difficulty, stop - start)
+        outputs[:, start:stop] = out
+        position = stop
+    return outputs
+
+
+def decode(decoder, encoder_hc, difficulty, steps, spectrograms, recall=None):
+    """
+    Runs the decoder for steps from the encoder state: every step, or with a recall only the steps near onsets
+    in any of the spectrograms (see generate_sparse).
+    @param spectrograms: The spectrograms of the songs as (frames, n_bins) tensors.
+    @return: (outputs, the number of decoder steps run)
+    """
+    if recall is None:
+        beatmaps, _, _ = decoder.generate(decoder.start_input(difficulty), encoder_hc, difficulty, steps)
+        return beatmaps, steps
+    mask = np.zeros(steps, dtype=bool)
+    for spectrogram in spectrograms:
+        mask |= candidate_steps(onset_candidates(spectrogram.T.cpu().numpy(), recall), steps)
+    return generate_sparse(decoder, decoder.start_input(difficulty), encoder_hc, difficulty, mask), int(mask.sum())
+
+
+####################################
+# Generation
+####################################
+
+
+def generate_batch(encoder, decoder, spectrograms, difficulties, recall=None):
+    """
+    Generates beatmaps for several songs at once: the spectrograms are padded into one batch for the encoder,
+    and the decoder runs its autoregressive loop for all of them as one batched tensor.
+    @param spectrograms: The spectrograms of the songs as (frames, n_bins) tensors on the model's device.
+    @param difficulties: The difficulty vector of each song.
+    @param recall: Decode only near onsets, keeping this fraction of them (None to decode every step, see decode).
+    @return: The decoder output of each song (steps x features), trimmed to the song's own length.
+    """
+    lengths = torch.tensor([s.shape[0] for s in spectrograms])
+    x = torch.nn.utils.rnn.pad_sequence(list(spectrograms), batch_first=True)
+    difficulty = torch.tensor(difficulties).float().to(x.device)
+    steps = [song_steps(n) for n in lengths.tolist()]
+    with torch.no_grad():
+        with metrics.timer("generate_seconds", "Generation time by phase", phase="encode"):
+            _, encoder_hc = encoder(x, lengths if len(spectrograms) > 1 else None)
+        with metrics.timer("generate_seconds", "Generation time by phase", phase="decode"):
+            beatmaps, run = decode(decoder, encoder_hc, difficulty, max(steps), spectrograms, recall)
+    metrics.counter("generate_decoder_steps_total", "Decoder steps run while generating").inc(run * len(steps))
+    return [beatmap[:n] for beatmap, n in zip(beatmaps, steps)]
+
+
+def generate_difficulties(encoder, decoder, spectrogram, difficulties, recall=None):
+    """
+    Generates beatmaps for one song at several difficulties: the song is encoded once, and the decoder runs its
+    autoregressive loop for every difficulty as one batched tensor.
+    @param spectrogram: The spectrogram of the song as a (frames, n_bins) tensor on the model's device.
+    @param difficulties: A list of difficulty vectors.
+    @param recall: Decode only near onsets, keeping this fraction of them (None to decode every step, see decode).
+    @return: The decoder output for each difficulty (steps x features).
+    """
+    difficulty = torch.tensor(difficulties).float().to(spectrogram.device)
+    steps = song_steps(spectrogram.shape[0])
+    with torch.no_grad():
+        with metrics.timer("generate_seconds", "Generation time by phase", phase="encode"):
+            _, (h, c) = encoder(spectrogram.unsqueeze(0))
+        # Every difficulty starts from the same encoder state
+        encoder_hc = tuple(x.expand(-1, len(difficulties), -1).contiguous() for x in (h, c))
+        with metrics.timer("generate_seconds", "Generation time by phase", phase="decode"):
+            beatmaps, run = decode(decoder, encoder_hc, difficulty, steps, [spectrogram], recall)
+    metrics.counter("generate_decoder_steps_total", "Decoder steps run while generating").inc(run * len(difficulties))
+    return list(beatmaps)
+
+
+def mapset_paths(output_path, count):
+    """
+    Returns the output path of each difficulty in a mapset: output_path itself for a single difficulty,
+    otherwise <name>_<n>.osu.
+    """
+    if count == 1:
+        return [output_path]
+    name, ext = os.path.splitext(output_path)
+    return [f"{name}_{i}{ext or '.osu'}" for i in range(count)]
+
+
+def generate_mapset(song_file, difficulties, output_path, backend="float", recall=None):
+    """
+    Generates one beatmap per difficulty vector for a given song, featurizing and encoding the song only once.
+    @param song_file: The song file name. (PATH NOT INCLUDED)
+    @param difficulties: A list of difficulty vectors.
+    @param output_path: The path to save the beatmap (see mapset_paths for several difficulties).
+    @param backend: The inference backend (see load_models).
+    @param recall: Decode only near onsets, keeping this fraction of them (None to decode every step, see decode).
+    @return: The paths of the saved beatmaps.
+    """
+    device = get_device(backend)
+
+    with metrics.timer("generate_seconds", "Generation time by phase", phase="featurize"):
+        spectrogram = convert_to_spectrogram(config.test_audio_path + song_file)
+    if spectrogram is None:
+        print(f"ERROR: Could not convert {song_file} to a spectrogram.")
+        return
+    spectrogram = torch.tensor(spectrogram.T).float().to(device)
+
+    models = load_models(device, backend)
+    if models is None:
+        return
+    encoder, decoder = models
+
+    beatmaps = generate_difficulties(encoder, decoder, spectrogram, difficulties, recall)
+    timing = estimate_timing(spectrogram.T.cpu().numpy())
+    paths = mapset_paths(output_path, len(difficulties))
+    for beatmap, difficulty, path in zip(beatmaps, difficulties, paths):
+        tensor_to_map(beatmap, difficulty, path, timing, os.path.basename(song_file))
+    return paths
 
 
+def generate_beatmap(song_file, difficulties, output_path, backend="float", recall=None):
+    """
+    Generates a beatmap for a given song.
+    @param song_path: The song file name. (PATH NOT INCLUDED)
+    @param output_path: The path to save the beatmap.
+    @param backend: The inference backend (see load_models).
+    @param recall: Decode only near onsets, keeping this fraction of them (None to decode every step, see decode).
+    """
+    generate_mapset(song_file, [difficulties], output_path, backend, recall)
+
+
+def generate_beatmap_stream(song_file, difficulties, output_path, window_frames=2048, backend="float"):
+    """
+    Generates a beatmap for a given song in windows, writing hit objects to the file as they are produced.
+    Memory use is bounded by the window size, so this works for songs of any length.
+    The encoder's forward state is carried across windows (the backward direction only sees its own window).
+    The decoder starts from the encoder state at the end of the first window, and its hidden state and last
+    row are carried from one window to the next, so the output continues as if it were decoded in one pass.
+    @param song_file: The song file name. (PATH NOT INCLUDED)
+    @param output_path: The path to save the beatmap.
+    @param window_frames: The number of spectrogram frames per window (2048 frames is about 95 seconds).
+    @param backend: The inference backend (see load_models).
+    """
+    device = get_device(backend)
+    models = load_models(device, backend)
+    if models is None:
+        return
+    encoder, decoder = models
+
+    difficulty = torch.tensor(difficulties).float().to(device).unsqueeze(0)
+    decoder_input = decoder.start_input(difficulty)
+    encoder_hc = None
+    decoder_hidden = None
+    frames = 0
+    steps = 0
+
+    with open(output_path, 'w', encoding='utf-8') as f, torch.no_grad():
+        # The tempo is not known before the whole song has been read, so streamed maps get the default timing point
+        f.write(format_header(difficulties, os.path.basename(song_file)) + format_timing_points() + "[HitObjects]\n")
+        blocks = stream_spectrogram(config.test_audio_path + song_file, block_frames=window_frames)
+        while True:
+            with metrics.timer("generate_seconds", "Generation time by phase", phase="featurize"):
+                block = next(blocks, None)
+            if block is None:
+                break
+            spectrogram = torch.tensor(block.T).float().to(device).unsqueeze(0)
+            with metrics.timer("generate_seconds", "Generation time by phase", phase="encode"):
+                _, (h, c) = encoder(spectrogram, hc=encoder_hc)
+            # Carry the forward direction into the next window; the backward direction starts fresh
+            encoder_hc = tuple(torch.stack((x[0], torch.zeros_like(x[1]))) for x in (h, c))
+
+            # Decode up to the end of this window on the target grid
+            frames += spectrogram.shape[1]
+            window_steps = song_steps(frames) - steps
+            with metrics.timer("generate_seconds", "Generation time by phase", phase="decode"):
+                if decoder_hidden is None:
+                    decoder_hidden = (h, c)
+                beatmap, decoder_hidden, decoder_input = decoder.generate(decoder_input, decoder_hidden, difficulty, window_steps)
+            metrics.counter("generate_decoder_steps_total", "Decoder steps run while generating").inc(window_steps)
+            f.write(format_hitobjects(decoder_events(beatmap[0], steps)))
+            f.flush()
+            steps += window_steps
+
+
+# Main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a beatmap for a song in " + config.test_audio_path)
+    parser.add_argument("song", nargs="?", default="7484.mp3", help="The song file name (in " + config.test_audio_path + ")")
+    parser.add_argument("output", nargs="?", default="output.osu", help="The path to save the beatmap")
+    parser.add_argument("--difficulty", nargs=6, type=float, action="append",
+                        metavar=("HP", "CS", "OD", "AR", "SV", "TICK"),
+                        help="The difficulty vector (default: all 5). Repeat to generate a mapset from one encoder pass; "
+                             "the maps are saved as <output>_<n>.osu")
+    parser.add_argument("--stream", action="store_true", help="Generate in windows with bounded memory (for long songs)")
+    parser.add_argument("--backend", choices=("float", "script", "int8"), default="float",
+                        help="The inference backend: the eager model, TorchScript, or TorchScript with an int8 decoder (see inference.py)")
+    parser.add_argument("--recall", type=float, default=None,
+                        help="Only run the decoder near onsets in the song, keeping this fraction of the onset peaks (e.g. 1.0); "
+                             "much faster, but objects off the onsets are not generated (default: decode every step)")
+    args = parser.parse_args()
+    difficulties = args.difficulty or [[5, 5, 5, 5, 5, 5]]
 
+    if args.stream:
+        if len(difficulties) > 1 or args.recall is not None:
+            parser.error("--stream generates one difficulty at a time, on every step")
+        generate_beatmap_stream(args.song, difficulties[0], args.output, backend=args.backend)
+    elif len(difficulties) > 1:
+        generate_mapset(args.song, difficulties, args.output, args.backend, args.recall)
+    else:
+        generate_beatmap(args.song, difficulties[0], args.output, args.backend, args.recall)
+    metrics.export()
@@ -0,0 +1,122 @@
+###########################
+# This file contains the bulk .osu parser.
+# Whole columns of a section are read with NumPy's C text parsers, so no Python code runs per field.
+# The output is the event table of the hit objects data_collector.getOutput reads line by line
+# (see beatmap_events.py), plus the [TimingPoints] section as a structured array.
+###########################
+
+
+# Python library imports
+import re
+import numpy as np
+
+# Our imports
+from beatmap_events import event_dtype
+
+
+# One row per timing point
+timing_dtype = np.dtype([
+    ("time", np.float64),
+    ("beat_length", np.float64),
+    ("meter", np.int32),
+    ("sample_set", np.int32),
+    ("sample_index", np.int32),
+    ("volume", np.int32),
+    ("uninherited", np.int32),
+    ("effects", np.int32),
+])
+
+# Default values of the optional timing point fields (older file formats leave them out)
+timing_defaults = {"meter": 4, "sample_set": 0, "sample_index": 0, "volume": 100, "uninherited": 1, "effects": 0}
+
+# Same bits as data_collector.get_curve_type
+curve_types = {"B": 0b0001, "C": 0b0010, "L": 0b0100, "P": 0b1000}
+
+section_re = re.compile(r"^\[(\w+)\][ \t]*\r?$", re.M)
+timing_re = re.compile(r"^[ \t]*(-?[\d.]+),(-?[\d.eE+-]+)(?:,(\d+))?(?:,(\d+))?(?:,(\d+))?(?:,(\d+))?(?:,(\d+))?(?:,(\d+))?", re.M)
+
+
+def read_sections(text):
+    """
+    Splits the text of an .osu file into its sections.
+    @return: A dict of section name -> section text (without the [Name] line).
+    """
+    parts = section_re.split(text)
+    return {parts[i]: parts[i + 1] for i in range(1, len(parts) - 1, 2)}
+
+
+def parse_hitobjects(text):
+    """
+    Parses the text of a [HitObjects] section.
+    @return: (events, offsets, values) as in beatmap_events.save_events.
+             Like data_collector.getOutput, a slider without slides/length makes the whole section empty.
+    """
+    lines = list(filter(str.strip, text.splitlines()))
+    events = np.zeros(len(lines), dtype=event_dtype)
+    empty = (events[:0], np.zeros(1, dtype=np.int64), np.zeros((0, 2), dtype=np.int32))
+    if len(lines) == 0:
+        return empty
+
+    # x,y,time,type are numeric on every line, so NumPy's C parser can read them in one go
+    cols = np.loadtxt(lines, delimiter=",", usecols=range(4), dtype=np.int64, ndmin=2)
+    events["x"] = cols[:, 0]
+    events["y"] = cols[:, 1]
+    events["time"] = cols[:, 2]
+    events["type"] = cols[:, 3]
+    events["curve"] = curve_types["B"]
+
+    is_slider = (events["type"] & 0b00000010) != 0
+    is_spinner = ~is_slider & ((events["type"] & 0b00001000) != 0)
+
+    spinner_lines = [lines[i] for i in np.flatnonzero(is_spinner)]
+    if len(spinner_lines) > 0:
+        events["end_time"][is_spinner] = np.loadtxt(spinner_lines, delimiter=",", usecols=5, dtype=np.int64, ndmin=1)
+
+    slider_lines = [lines[i] for i in np.flatnonzero(is_slider)]
+    counts = np.zeros(len(lines), dtype=np.int64)
+    values = np.zeros((0, 2), dtype=np.int32)
+    if len(slider_lines) > 0:
+        try:
+            lengths = np.loadtxt(slider_lines, delimiter=",", usecols=(6, 7), dtype=np.float64, ndmin=2)
+        except ValueError:
+            return empty
+        curves = np.loadtxt(slider_lines, delimiter=",", usecols=5, dtype=str, ndmin=1, comments=None)
+        letters = curves.astype("U1")
+        events["curve"][is_slider] = np.select([letters == letter for letter in curve_types], list(curve_types.values()), 0)
+        events["slides"][is_slider] = lengths[:, 0]
+        events["length"][is_slider] = lengths[:, 1]
+
+        # Every curve point is one x:y pair, so the number of ':' is the number of points
+        counts[is_slider] = np.char.count(curves, ":")
+        points = ",".join(filter(None, (curve[2:] for curve in curves))).replace("|", ",").replace(":", ",")
+        values = np.fromstring(points, dtype=np.int64, sep=",").reshape(-1, 2).astype(np.int32) if points else values
+
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return events, offsets, values
+
+
+def parse_timing_points(text):
+    """
+    Parses the text of a [TimingPoints] section into a structured array.
+    """
+    rows = np.array(timing_re.findall(text), dtype=str).reshape(-1, 8)
+    points = np.zeros(len(rows), dtype=timing_dtype)
+    points["time"] = rows[:, 0].astype(np.float64)
+    points["beat_length"] = rows[:, 1].astype(np.float64)
+    for col, name in enumerate(timing_dtype.names[2:], start=2):
+        column = rows[:, col]
+        points[name] = timing_defaults[name]
+        present = column != ""
+        points[name][present] = column[present].astype(np.int64)
+    return points
+
+
+def parse_file(filename):
+    """
+    Parses the hit objects and timing points of an .osu file.
+    @return: (events, offsets, values, timing points)
+    """
+    with open(filename, "r", encoding="utf-8-sig") as f:
+        sections = read_sections(f.read())
+    return (*parse_hitobjects(sections.get("HitObjects", "")), parse_timing_points(sections.get("TimingPoints", "")))
@@ -0,0 +1,171 @@
+###########################
+# This file contains the .osu writer (the inverse of osu_parser.py).
+# Hit objects come in as an event table (see beatmap_events.py), optionally with their ragged slider points,
+# and are formatted a whole column at a time with NumPy string operations. The file is built as one string and
+# written in a single call, so writing a map costs a few milliseconds however long the song is.
+###########################
+
+
+# Python library imports
+import os
+import numpy as np
+
+# Our imports
+from osu_parser import timing_dtype, curve_types
+
+
+# Curve letter of every curve bit pattern (the inverse of data_collector.get_curve_type); unknown bits become B
+curve_letters = np.full(16, "B")
+for letter, bits in curve_types.items():
+    curve_letters[bits] = letter
+
+# Type bits kept from the model's output: new combo and combo colour skip
+combo_bits = 0b01110100
+
+# The playfield size in osu! pixels
+playfield = (512, 384)
+
+# The timing point used when none is given (120 BPM from the start of the song)
+default_timing = np.array([(0, 500, 4, 0, 0, 100, 1, 0)], dtype=timing_dtype)
+
+
+def format_header(difficulties, audio_filename="", title="", artist="", version=None):
+    """
+    Returns the [General], [Metadata] and [Difficulty] sections of a beatmap.
+    @param difficulties: The difficulty vector (HP, CS, OD, AR, slider multiplier, slider tick rate).
+    @param version: The difficulty name (defaults to one made from the difficulty vector, so the maps of a
+    mapset get different names).
+    """
+    hp, cs, od, ar, sv, tick = difficulties
+    if version is None:
+        version = f"HP{hp:g} CS{cs:g} OD{od:g} AR{ar:g}"
+    return (
+        "osu file format v14\n\n"
+        "[General]\n"
+        f"AudioFilename: {audio_filename}\n"
+        "AudioLeadIn: 0\n"
+        "PreviewTime: -1\n"
+        "Mode: 0\n\n"
+        "[Metadata]\n"
+        f"Title:{title}\n"
+        f"Artist:{artist}\n"
+        "Creator:osu-beatmap-generator\n"
+        f"Version:{version}\n\n"
+        "[Difficulty]\n"
+        f"HPDrainRate:{hp}\n"
+        f"CircleSize:{cs}\n"
+        f"OverallDifficulty:{od}\n"
+        f"ApproachRate:{ar}\n"
+        f"SliderMultiplier:{sv}\n"
+        f"SliderTickRate:{tick}\n\n"
+    )
+
+
+def format_timing_points(timing=default_timing):
+    """
+    Returns the [TimingPoints] section for a structured array of timing points (see osu_parser.timing_dtype).
+    """
+    if len(timing) == 0:
+        return "[TimingPoints]\n\n"
+    columns = [np.round(timing["time"]).astype(np.int64), timing["beat_length"]] + [timing[name] for name in timing_dtype.names[2:]]
+    return "[TimingPoints]\n" + "".join(join_columns(columns, "\n").tolist()) + "\n"
+
+
+def join_columns(columns, end=""):
+    """
+    Joins columns row-wise with commas, appending end to every row. Returns an object array of strings.
+    (Adding object arrays of str runs str.__add__ per element, which is much faster than np.char.add.)
+    """
+    out = strings(columns[0])
+    for column in columns[1:]:
+        out = out + "," + strings(column)
+    return out + end
+
+
+def strings(column):
+    """
+    Converts a column to an object array of str.
+    """
+    out = np.empty(len(column), dtype=object)
+    out[:] = list(map(str, np.asarray(column).tolist()))
+    return out
+
+
+def curve_point_strings(events, offsets, values):
+    """
+    Returns the curve points of every event as "x:y|x:y|..." ("" for events without points), clipped to the
+    playfield.
+    """
+    out = np.full(len(events), "", dtype=object)
+    counts = np.diff(offsets)
+    has_points = counts > 0
+    if len(values) == 0 or not has_points.any():
+        return out
+    points = strings(np.clip(values[:, 0], 0, playfield[0])) + ":" + strings(np.clip(values[:, 1], 0, playfield[1]))
+    # Separate points with | and events with a newline, then split the joined string at the newlines
+    separators = np.full(len(points), "|", dtype=object)
+    separators[offsets[1:][has_points] - 1] = "\n"
+    out[has_points] = "".join((points + separators).tolist()).split("\n")[:-1]
+    return out
+
+
+def format_hitobjects(events, offsets=None, values=None):
+    """
+    Returns the hit object lines of an event table (without the [HitObjects] line).
+    Positions and curve points are clipped to the playfield (the decoder's predictions can fall outside it).
+    Sliders use their curve points if offsets/values are given. Otherwise (e.g. for decoder output, which has no
+    points) they get a single point: a straight line of the slider's length from its start, inside the playfield.
+    @param events: The event table (sorted by time).
+    @param offsets: The slider point offsets of each event (see beatmap_events.save_events).
+    @param values: The slider points (x, y).
+    """
+    if len(events) == 0:
+        return ""
+    type = events["type"]
+    # A slider with neither a length nor curve points cannot be played, so it is written as a circle
+    has_points = np.diff(offsets) > 0 if offsets is not None else np.zeros(len(events), dtype=bool)
+    is_slider = ((type & 0b00000010) != 0) & ((events["length"] > 0) | has_points)
+    is_spinner = ((type & 0b00000010) == 0) & ((type & 0b00001000) != 0)
+
+    x = np.where(is_spinner, playfield[0] // 2, np.clip(events["x"], 0, playfield[0]))
+    y = np.where(is_spinner, playfield[1] // 2, np.clip(events["y"], 0, playfield[1]))
+    kind = np.select([is_slider, is_spinner], [0b00000010, 0b00001000], 0b00000001)
+    lines = join_columns([x, y, events["time"], (type & combo_bits) | kind, np.zeros(len(events), dtype=np.int64)], ",")
+
+    tails = np.full(len(events), "0:0:0:0:", dtype=object)
+    spinners = np.flatnonzero(is_spinner)
+    if len(spinners) > 0:
+        end_time = np.maximum(events["end_time"][spinners], events["time"][spinners])
+        tails[spinners] = strings(end_time) + ",0:0:0:0:"
+    sliders = np.flatnonzero(is_slider)
+    if len(sliders) > 0:
+        points = curve_point_strings(events, offsets, values)[sliders] if offsets is not None else np.full(len(sliders), "", dtype=object)
+        # Sliders without points end at a straight line of their length, going left if right would leave the playfield
+        length = np.maximum(events["length"][sliders], 0)
+        sx, sy = x[sliders], y[sliders]
+        end_x = np.clip(np.where(sx + length <= playfield[0], sx + length, sx - length), 0, playfield[0]).astype(np.int64)
+        points = np.where(points == "", strings(end_x) + ":" + strings(sy), points)
+        curve = strings(curve_letters[events["curve"][sliders] & 0b1111])
+        tails[sliders] = join_columns([curve + "|" + points, np.maximum(events["slides"][sliders], 1),
+                                       np.round(length.astype(np.float64), 2)])
+    lines = lines + tails
+    return "\n".join(lines.tolist()) + "\n"
+
+
+def format_beatmap(events, difficulties, timing=default_timing, offsets=None, values=None, **metadata):
+    """
+    Returns the text of a complete .osu file.
+    @param metadata: audio_filename, title, artist and version for the header (see format_header).
+    """
+    return format_header(difficulties, **metadata) + format_timing_points(timing) + "[HitObjects]\n" + \
+        format_hitobjects(events, offsets, values)
+
+
+def write_beatmap(filename, events, difficulties, timing=default_timing, offsets=None, values=None, **metadata):
+    """
+    Writes a complete .osu file in one call (to a temporary file first, so a map is never left half-written).
+    """
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(format_beatmap(events, difficulties, timing, offsets, values, **metadata))
+    os.replace(tmp_path, filename)
@@ -0,0 +1,28 @@
+# The single-call teacher-forced decoder pass against the step-by-step loop (see model.Decoder)
+import pytest
+import torch
+
+from model import Decoder, device, num_features
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_teacher_forcing_matches_loop(batched):
+    torch.manual_seed(0)
+    decoder = Decoder().eval()
+    batch, steps = 3, 50
+    target = torch.rand(batch, steps, num_features, device=device)
+    difficulty = torch.rand(batch, 6, device=device)
+    encoder_hc = tuple(torch.randn(2, batch, decoder.hidden_dim, device=device) for _ in range(2))
+    encoder_out = torch.zeros(batch, 10, decoder.hidden_dim, device=device) # (not read when teacher-forced)
+    if not batched:
+        target, difficulty, encoder_out = target[0], difficulty[0], encoder_out[0]
+        encoder_hc = tuple(x[:, 0] for x in encoder_hc)
+
+    with torch.no_grad():
+        out, (h, c), _ = decoder(encoder_out, encoder_hc, difficulty, target)
+        loop_out, (loop_h, loop_c), _ = decoder(encoder_out, encoder_hc, difficulty, target, step_by_step=True)
+
+    assert out.shape == loop_out.shape == target.shape
+    torch.testing.assert_close(out, loop_out, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(h, loop_h, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(c, loop_c, rtol=1e-4, atol=1e-5)
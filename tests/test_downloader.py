@@ -0,0 +1,111 @@
+# Retries of the map downloader against a local server (see downloader.MapDownloader.fetch)
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import downloader
+
+
+# The responses each path gives, in order (the last one repeats): (status, headers)
+script = {
+    "/1": [(503, {}), (502, {}), (200, {})],
+    "/2": [(429, {"Retry-After": "3"}), (200, {})],
+    "/3": [(404, {})],
+    "/4": [(500, {})],
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            responses = script[self.path]
+            count = self.server.requests.get(self.path, 0)
+            self.server.requests[self.path] = count + 1
+        status, headers = responses[min(count, len(responses) - 1)]
+        body = f"map {self.path[1:]}".encode() if status == 200 else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.lock = threading.Lock()
+    httpd.requests = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Records the delays between retries instead of waiting them out.
+    """
+    delays = []
+    monkeypatch.setattr(downloader.time, "sleep", delays.append)
+    return delays
+
+
+def make_downloader(server, retries=3):
+    return downloader.MapDownloader(f"http://127.0.0.1:{server.server_port}/", max_in_flight=2, rate_limit=None,
+                                    retries=retries, timeout=5, backoff=0.5)
+
+
+def test_retries_server_errors(server, sleeps):
+    d = make_downloader(server)
+    assert d.fetch(1) == (200, b"map 1")
+    assert server.requests["/1"] == 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.5 and 0 <= sleeps[1] <= 1.0 # full jitter up to the doubling backoff
+    d.close()
+
+
+def test_honours_retry_after(server, sleeps):
+    d = make_downloader(server)
+    assert d.fetch(2) == (200, b"map 2")
+    assert server.requests["/2"] == 2
+    assert len(sleeps) == 1 and 3 <= sleeps[0] <= 3.5
+    d.close()
+
+
+def test_client_errors_are_not_retried(server, sleeps):
+    d = make_downloader(server)
+    assert d.fetch(3) == (404, b"")
+    assert server.requests["/3"] == 1
+    assert sleeps == []
+    d.close()
+
+
+def test_gives_up_after_retries(server, sleeps):
+    d = make_downloader(server, retries=2)
+    assert d.fetch(4) == (500, None)
+    assert server.requests["/4"] == 3
+    assert len(sleeps) == 2
+    d.close()
+
+
+def test_connection_errors_are_retried(sleeps):
+    d = downloader.MapDownloader("http://127.0.0.1:9/", max_in_flight=1, rate_limit=None, retries=1, timeout=1, backoff=0.5)
+    assert d.fetch(1) == (None, None)
+    assert len(sleeps) == 1
+    d.close()
+
+
+def test_run_downloads_every_id(server, sleeps):
+    d = make_downloader(server)
+    results = {}
+    d.run(iter([1, 2, 3]), lambda id, status, content: results.__setitem__(id, status))
+    assert results == {1: 200, 2: 200, 3: 404}
+    d.close()
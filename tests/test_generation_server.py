@@ -0,0 +1,26 @@
+# Output paths of generation jobs (see generation_server.resolve_output)
+import os
+
+import pytest
+
+from generation_server import resolve_output
+
+
+def test_paths_inside_the_output_folder(tmp_path):
+    root = os.path.realpath(tmp_path)
+    assert resolve_output(str(tmp_path), "map.osu") == os.path.join(root, "map.osu")
+    assert resolve_output(str(tmp_path), "songs/a/../map.osu") == os.path.join(root, "songs", "map.osu")
+
+
+@pytest.mark.parametrize("output", ["../map.osu", "songs/../../map.osu", "/etc/passwd", ".", ""])
+def test_paths_outside_are_rejected(tmp_path, output):
+    with pytest.raises(ValueError):
+        resolve_output(str(tmp_path / "outputs"), output)
+
+
+def test_symlinks_out_of_the_folder_are_rejected(tmp_path):
+    (tmp_path / "outputs").mkdir()
+    (tmp_path / "elsewhere").mkdir()
+    os.symlink(tmp_path / "elsewhere", tmp_path / "outputs" / "link")
+    with pytest.raises(ValueError):
+        resolve_output(str(tmp_path / "outputs"), "link/map.osu")
@@ -0,0 +1,79 @@
+# The bulk .osu parser against the line-by-line one, and the writer round trip (see osu_parser.py, osu_writer.py)
+import os
+
+import numpy as np
+
+import data_collector
+import osu_parser
+import osu_writer
+from beatmap_events import event_dtype
+
+
+sample = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sample.osu")
+difficulties = [5, 4, 7, 8.5, 1.4, 1]
+
+
+# Columns of the line-by-line parser's rows
+columns = ("x", "y", "time", "type", "curve", "slides", "length", "end_time")
+
+
+def reference_events(filename):
+    """
+    Runs the line-by-line parser and converts its rows and slider points into an event table.
+    """
+    target, sliderpts = data_collector.getOutput(filename)
+    events = np.zeros(len(target), dtype=event_dtype)
+    rows = np.asarray(target, dtype=np.float64)
+    for col, name in enumerate(columns):
+        events[name] = rows[:, col]
+    offsets = np.zeros(len(target) + 1, dtype=np.int64)
+    offsets[1:][(events["type"] & 0b10) != 0] = [len(pts) for pts in sliderpts]
+    return events, np.cumsum(offsets), np.array([pt for pts in sliderpts for pt in pts]).reshape(-1, 2)
+
+
+def reference_timing(filename):
+    """
+    Reads the [TimingPoints] section one line and one field at a time.
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        lines = f.read().split("[TimingPoints]")[1].split("[")[0].splitlines()
+    rows = []
+    for line in filter(str.strip, lines):
+        fields = line.split(",")
+        row = [float(fields[0]), float(fields[1])]
+        for i, name in enumerate(osu_parser.timing_dtype.names[2:], start=2):
+            row.append(int(fields[i]) if i < len(fields) else osu_parser.timing_defaults[name])
+        rows.append(tuple(row))
+    return np.array(rows, dtype=osu_parser.timing_dtype)
+
+
+def test_parsers_agree():
+    events, offsets, values, timing = osu_parser.parse_file(sample)
+    ref_events, ref_offsets, ref_values = reference_events(sample)
+
+    assert len(events) == 9
+    for name in event_dtype.names:
+        np.testing.assert_array_equal(events[name], ref_events[name], err_msg=name)
+    np.testing.assert_array_equal(offsets, ref_offsets)
+    np.testing.assert_array_equal(values, ref_values)
+
+    ref_timing = reference_timing(sample)
+    assert len(timing) == 5
+    for name in osu_parser.timing_dtype.names:
+        np.testing.assert_array_equal(timing[name], ref_timing[name], err_msg=name)
+
+
+def test_writer_round_trip(tmp_path):
+    events, offsets, values, timing = osu_parser.parse_file(sample)
+    filename = str(tmp_path / "out.osu")
+    osu_writer.write_beatmap(filename, events, difficulties, timing, offsets, values, audio_filename="audio.mp3")
+
+    events2, offsets2, values2, timing2 = osu_parser.parse_file(filename)
+    np.testing.assert_array_equal(events2, events)
+    np.testing.assert_array_equal(offsets2, offsets)
+    np.testing.assert_array_equal(values2, values)
+    np.testing.assert_array_equal(timing2, timing)
+
+    # The line-by-line parser reads the written file too
+    ref_events, _, _ = reference_events(filename)
+    np.testing.assert_array_equal(ref_events, events)
@@ -0,0 +1,51 @@
+# Mid-epoch resume of the training loader (see model.ResumableBatchSampler and checkpoint.py)
+import pytest
+import torch
+from torch.utils.data import Subset
+
+from train import make_loader
+
+
+class TinyDataset(torch.utils.data.Dataset):
+    """
+    Samples of different lengths whose difficulty vector holds their index, so batches can be told apart.
+    """
+    def __init__(self, n=24):
+        self.lengths = [10 + 3 * i for i in range(n)]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def get_lengths(self, indices=None):
+        return [self.lengths[i] for i in (range(len(self)) if indices is None else indices)]
+
+    def __getitem__(self, idx):
+        return torch.zeros(4, 84), torch.full((6,), float(idx)), torch.zeros(self.lengths[idx], 8)
+
+
+def batch_ids(batch):
+    return sorted(int(i) for i in batch[1][:, 0])
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_resume_mid_epoch(workers):
+    dataset = TinyDataset()
+    subset = Subset(dataset, list(range(len(dataset))))
+    torch.manual_seed(0)
+    loader = make_loader(dataset, subset, batch_size=4, workers=workers, window=None)
+    epoch = []
+    for i, batch in enumerate(loader):
+        epoch.append(batch_ids(batch))
+        if i == 1:
+            state = loader.batch_sampler.state_dict()
+    assert len(epoch) == len(loader)
+
+    # A new run restores the order after two batches and trains only the rest of the epoch
+    resumed = make_loader(dataset, subset, batch_size=4, workers=workers, window=None)
+    resumed.batch_sampler.load_state_dict(state, 2)
+    assert [batch_ids(batch) for batch in resumed] == epoch[2:]
+
+    # The next epoch is a whole (new) one
+    next_epoch = [batch_ids(batch) for batch in resumed]
+    assert len(next_epoch) == len(loader)
+    assert sorted(i for batch in next_epoch for i in batch) == list(range(len(dataset)))
@@ -0,0 +1,167 @@
+#################################
+# Description: This script trains the encoder/decoder on the collected dataset.
+# Songs are batched by length (see BucketBatchSampler) so one optimizer step covers many songs.
+# NOTE: This script should ONLY be run after data has been collected (see data_collector.py).
+#################################
+
+# Python library imports
+import torch
+import os
+import time
+from torch.optim import Adam
+from torch.utils.data import DataLoader, random_split
+
+# Our imports
+import config
+import metrics
+from checkpoint import CheckpointManager, restore
+from model import Audio2Map, Encoder, Decoder, BucketBatchSampler, WindowBatchSampler, collate_maps, masked_mse_loss, tsprint, device
+
+# Configuration
+model_path = config.model_path
+batch_size = 16
+
+
+def make_loader(dataset, subset, batch_size=batch_size, shuffle=True, workers=config.loader_workers, window=config.window_length):
+    """
+    Creates a DataLoader over a subset of the dataset that yields length-bucketed, padded batches.
+    With a window length, batches are made of random fixed-length windows of the songs instead (see WindowBatchSampler).
+    Batches are loaded by worker processes, which decode and featurize the next songs while the current batch
+    trains, and hand them over through shared memory.
+    @param dataset: The full Audio2Map dataset.
+    @param subset: A Subset of the dataset (e.g. from random_split).
+    @param workers: The number of worker processes (0 to load in the training process).
+    @param window: The window length in ms (None to train on whole songs).
+    """
+    if window is not None:
+        # Windows are addressed by dataset index, so they go to the dataset itself rather than the subset
+        sampler = WindowBatchSampler(subset.indices, dataset.get_lengths(subset.indices), batch_size, window, shuffle=shuffle)
+        subset = dataset
+    else:
+        sampler = BucketBatchSampler(dataset.get_lengths(subset.indices), batch_size, shuffle=shuffle)
+    # The loader draws its worker seeds from its own generator, so a resumed run sees the same global RNG as
+    # the run it continues (see checkpoint.py)
+    generator = torch.Generator()
+    if workers == 0:
+        return DataLoader(subset, batch_sampler=sampler, collate_fn=collate_maps, generator=generator)
+    return DataLoader(subset, batch_sampler=sampler, collate_fn=collate_maps, generator=generator, num_workers=workers,
+                      prefetch_factor=config.loader_prefetch, persistent_workers=True, pin_memory=torch.cuda.is_available())
+
+
+def train_step(batch, encoder, decoder, encoder_opt, decoder_opt, lossfunc):
+    """
+    Runs one optimizer step on a batch from collate_maps. Returns the loss.
+    """
+    x, diff, y, x_lengths, y_lengths = [t.to(device) for t in batch]
+
+    encoder_opt.zero_grad()
+    decoder_opt.zero_grad()
+
+    encoder_outputs, encoder_hc = encoder(x, x_lengths)
+    decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hc, diff, target=y)
+
+    loss = lossfunc(decoder_outputs, y, y_lengths)
+    loss.backward()
+
+    encoder_opt.step()
+    decoder_opt.step()
+    return loss
+
+def train_epoch(data, encoder, decoder, encoder_opt, decoder_opt, lossfunc, first_batch=0, on_batch=None):
+    """
+    Trains the model for one epoch. Returns the average loss per batch.
+    @param first_batch: The number of batches of the epoch already trained (when resuming mid-epoch).
+    @param on_batch: Called with the number of batches of the epoch done after every batch (e.g. to checkpoint).
+    """
+    total_loss = 0
+    num_batches = 0
+    num_samples = 0
+    epoch_start = time.perf_counter()
+    wait_start = epoch_start
+    for i, batch in enumerate(data, first_batch):
+        # Time spent waiting for the loader vs. time spent in the step tells I/O-bound from compute-bound
+        compute_start = time.perf_counter()
+        metrics.histogram("train_data_wait_seconds", "Time waiting for the next batch").observe(compute_start - wait_start)
+        if batch is None:
+            if on_batch is not None:
+                on_batch(i + 1)
+            wait_start = time.perf_counter()
+            continue
+        x = batch[0]
+        loss = train_step(batch, encoder, decoder, encoder_opt, decoder_opt, lossfunc)
+
+        total_loss += loss.item() # (waits for the step to finish on the GPU)
+        num_batches += 1
+        num_samples += x.shape[0]
+        compute_time = time.perf_counter() - compute_start
+        metrics.histogram("train_compute_seconds", "Time in a training step").observe(compute_time)
+        metrics.counter("train_samples_total", "Songs (or song windows) trained on").inc(x.shape[0])
+        metrics.counter("train_decoder_steps_total", "Decoder steps (real target rows) trained on").inc(int(batch[4].sum()))
+        metrics.gauge("train_decoder_steps_per_second", "Decoder steps per second of the last step").set(int(batch[4].sum()) / compute_time)
+        tsprint(f"Batch {i + 1} ({x.shape[0]} samples) trained successfully! Loss: {loss.item()}")
+
+        if on_batch is not None:
+            on_batch(i + 1)
+        wait_start = time.perf_counter()
+
+    metrics.gauge("train_samples_per_second", "Songs per second over the last epoch").set(num_samples / (time.perf_counter() - epoch_start))
+    return total_loss / max(num_batches, 1)
+
+
+def train(data, encoder, decoder, epochs=10, learning_rate=1e-4, checkpoints=None):
+    """
+    Trains the model. Returns the loss history.
+    With a CheckpointManager, training continues from its latest checkpoint (if any), and a checkpoint is saved
+    every config.checkpoint_interval batches and at the end of every epoch.
+    """
+    start = time.time()
+    losshistory = []
+
+    enc_opt = Adam(encoder.parameters(), lr=learning_rate)
+    dec_opt = Adam(decoder.parameters(), lr=learning_rate)
+    first_epoch, first_batch, step = 0, 0, 0
+    checkpoint = checkpoints.latest() if checkpoints is not None else None
+    if checkpoint is not None:
+        first_epoch, first_batch, step = restore(checkpoint, encoder, decoder, enc_opt, dec_opt, data.batch_sampler)
+        if first_batch >= len(data): # the checkpoint was taken at the end of an epoch
+            first_epoch, first_batch = first_epoch + 1, 0
+        tsprint(f"Resuming from checkpoint {step} (epoch {first_epoch + 1}, batch {first_batch})")
+
+    for epoch in range(first_epoch, epochs):
+        tsprint(f"Epoch: {epoch+1}")
+        epoch_start_step = step - first_batch
+
+        def on_batch(done):
+            if checkpoints is not None and (done % config.checkpoint_interval == 0 or done == len(data)):
+                checkpoints.save(epoch_start_step + done, encoder, decoder, enc_opt, dec_opt, epoch, done, data.batch_sampler)
+
+        loss = train_epoch(data, encoder, decoder, enc_opt, dec_opt, masked_mse_loss, first_batch, on_batch)
+        step = epoch_start_step + len(data)
+        first_batch = 0
+        curr_time = time.time()
+        losshistory.append(loss)
+        print(f"Loss: {loss} Time: {curr_time - start}")
+    return losshistory
+
+
+# Main
+if __name__ == "__main__":
+    a2m_data = Audio2Map(config.audio_path, config.map_path, config.pickle_path)
+
+    test_split = 0.2
+    train_data, test_data = random_split(a2m_data, [1-test_split, test_split], generator=torch.Generator().manual_seed(config.split_seed))
+    train_dl = make_loader(a2m_data, train_data)
+
+    enc = Encoder(0.4).to(device)
+    dec = Decoder(0.4).to(device)
+    os.makedirs(model_path, exist_ok=True)
+    if os.path.isfile(model_path + "encoder.pth"): enc.load_state_dict(torch.load(model_path + "encoder.pth"))
+    if os.path.isfile(model_path + "decoder.pth"): dec.load_state_dict(torch.load(model_path + "decoder.pth"))
+
+    exporter = metrics.Exporter()
+    checkpoints = CheckpointManager()
+    try:
+        train_loss = train(train_dl, enc, dec, epochs=5, checkpoints=checkpoints)
+    finally:
+        checkpoints.close() # writes the last checkpoint (and encoder.pth/decoder.pth)
+        exporter.stop()